@@ -16,8 +16,12 @@ from flask import Flask
 from autobahn.twisted.websocket import WebSocketServerFactory
 from autobahn.twisted.resource import WebSocketResource, WSGIRootResource
 
+from .authenticator import HMACAuthenticator
 from .db import db
+from .models.session_model import WBSessionModel
+from .password_hasher import password_hasher
 from .push_service import NotificationService
+from .session_sweeper import AccessTimeFlusher, SessionSweeper
 
 logger = Logger()
 
@@ -38,6 +42,9 @@ def create_app(config):
 
     config.init_app(app)
     db.init_app(app)
+    password_hasher.init_app(app)
+    if app.config.get('WOODBOX_AUTHENTICATE_BEFORE_REQUEST', True):
+        HMACAuthenticator.init_app(app, app.config.get('WOODBOX_REJECT_INVALID_AUTHORIZATION', True))
 
     return app
 
@@ -70,5 +77,28 @@ def create_server(app, port):
     ##
     site = Site(root_resource)
 
+    ##
+    # delete expired sessions in the background
+    ##
+    sweep_interval = app.config.get('WOODBOX_SESSION_SWEEP_INTERVAL')
+    if sweep_interval:
+        SessionSweeper(app, interval=sweep_interval).start()
+
+    ##
+    # write pending session access times periodically and before exiting
+    ##
+    if WBSessionModel.access_recorder is not None:
+        AccessTimeFlusher(app, WBSessionModel.access_recorder).start()
+
+        def flush_session_access_times():
+            with app.app_context():
+                WBSessionModel.access_recorder.flush()
+        reactor.addSystemEventTrigger('before', 'shutdown', flush_session_access_times)
+
+    ##
+    # stop the password hashing processes
+    ##
+    reactor.addSystemEventTrigger('before', 'shutdown', password_hasher.close)
+
     reactor.listenTCP(port, site)
     reactor.run()
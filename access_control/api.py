@@ -1,6 +1,9 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
+
+from collections import defaultdict
 from functools import wraps
 
 import miracle
@@ -8,10 +11,99 @@ import miracle
 from flask import g
 from flask_restful import abort
 
-from ..models.user_model import WBUserModel, WBRoleModel
+from ..models.user_model import WBUserModel
+
+
+# Action checked for each API function name.
+funcname_to_action = {'post': 'create',
+                      'get': 'read',
+                      'patch': 'update',
+                      'delete': 'delete'}
+
+
+class DecisionTable(object):
+    """Compiled, read-only form of the grants of an Acl.
+
+    The table maps (role, resource) to the frozenset of granted
+    actions. The union for a set of roles is computed once and kept in
+    an answer cache, so that checking a request costs a dictionary
+    lookup. A table is never modified after it is built: the Acl
+    replaces it by a new one when its grants change.
+    """
+    # Maximum number of cached answers.
+    max_answers = 10000
+
+    def __init__(self, grants):
+        table = defaultdict(set)
+        for role, resource, action in grants:
+            table[(role, resource)].add(action)
+        self._table = {key: frozenset(actions) for key, actions in table.items()}
+        self._answers = dict()
+
+    def actions(self, roles, resource):
+        """Return the frozenset of actions granted to any of `roles` on `resource`."""
+        if not isinstance(roles, frozenset):
+            roles = frozenset(roles)
+        key = (roles, resource)
+        actions = self._answers.get(key)
+        if actions is None:
+            actions = frozenset().union(*[self._table.get((r, resource), ()) for r in roles])
+            if len(self._answers) < self.max_answers:
+                self._answers[key] = actions
+        return actions
+
+
+def _recompiles(method):
+    """Make a method modifying the grants rebuild the decision table."""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            result = method(self, *args, **kwargs)
+            self.decisions = DecisionTable(self._grants)
+        return result
+    return wrapper
+
 
 class Acl(miracle.Acl):
-    """Implements access control list on API functions."""
+    """Implements access control list on API functions.
+
+    Checks are answered by :attr:`decisions`, a :class:`DecisionTable`
+    rebuilt whenever the grants are modified. Requests only read the
+    attribute, so they never wait for a lock; use
+    :meth:`replace_grants` to change all the grants at once while the
+    application is running.
+    """
+    def __init__(self):
+        super(Acl, self).__init__()
+        self._lock = threading.Lock()
+        self.decisions = DecisionTable(())
+
+    grant = _recompiles(miracle.Acl.grant)
+    grants = _recompiles(miracle.Acl.grants)
+    revoke = _recompiles(miracle.Acl.revoke)
+    revoke_all = _recompiles(miracle.Acl.revoke_all)
+    del_role = _recompiles(miracle.Acl.del_role)
+    del_resource = _recompiles(miracle.Acl.del_resource)
+    del_permission = _recompiles(miracle.Acl.del_permission)
+    clear = _recompiles(miracle.Acl.clear)
+
+    def replace_grants(self, grants):
+        """Replace all the grants by `grants`, a { role: { resource: [actions] } } dict.
+
+        Requests being authorized see either the old or the new grants,
+        never a mix of both.
+        """
+        acl = miracle.Acl().grants(grants)
+        with self._lock:
+            self._roles, self._structure, self._grants = acl._roles, acl._structure, acl._grants
+            self.decisions = DecisionTable(self._grants)
+        return self
+
+    def check(self, role, resource, permission):
+        return permission in self.decisions.actions((role,), resource)
+
+    def check_any(self, roles, resource, permission):
+        return permission in self.decisions.actions(roles, resource)
 
     def authorize(self, f):
         """A decorator to add access control to an API function.
@@ -36,23 +128,16 @@ class Acl(miracle.Acl):
         f -- The function to decorate. Its name should be ``post``, ``get``, ``patch`` or ``delete``.
 
         """
+        action = funcname_to_action[f.__name__]
+
         @wraps(f)
         def wrapper(*args, **kwargs):
             myself = f.__self__
-            funcname_to_action = {'post': 'create',
-                                  'get': 'read',
-                                  'patch': 'update',
-                                  'delete': 'delete'}
-
-            if g.user is None:
-                roles = [WBRoleModel.anonymous_role_name]
-            else:
-                user = WBUserModel.query.get(g.user)
-                roles = [r.rolename for r in user.roles]
+            roles = WBUserModel.get_roles(g.user).names
 
-            if self.check_any(roles, myself.resource_name, funcname_to_action[f.__name__]):
+            if action in self.decisions.actions(roles, myself.resource_name):
                 return f(*args, **kwargs)
             else:
-                abort(405, errors=["User role is not in resource access control list for '{0}' operation.".format(funcname_to_action[f.__name__])])
+                abort(405, errors=["User role is not in resource access control list for '{0}' operation.".format(action)])
 
         return wrapper
@@ -3,10 +3,41 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 from abc import ABCMeta, abstractmethod
 
-from sqlalchemy import and_, or_, true, false, text
+from sqlalchemy import and_, or_, true, false, text, exists
+from sqlalchemy.sql.elements import True_, False_
 
-from ..models.user_model import WBUserModel, WBRoleModel
+from ..models.user_model import WBUserModel
 from ..models.record_acl_model import RecordACLModel
+from ..utils.cache import TTLCache
+
+
+def _combine(alters, conjunction, absorbing, neutral):
+    """Combine alterations with `conjunction` (``and_`` or ``or_``).
+
+    A constant filter of type `absorbing` short-circuits the
+    combination and constant filters of type `neutral` are dropped,
+    along with their joins. Identical joins are merged.
+    """
+    outerjoins = []
+    filters = []
+    for alter in alters:
+        f = alter['filter']
+        if isinstance(f, absorbing):
+            return {'outerjoin': [], 'filter': f}
+        elif isinstance(f, neutral):
+            continue
+        for j in alter['outerjoin']:
+            if not any(j['table'] is o['table'] and j['on'].compare(o['on']) for o in outerjoins):
+                outerjoins.append(j)
+        filters.append(f)
+
+    if not filters:
+        return {'outerjoin': [], 'filter': neutral()}
+    elif len(filters) == 1:
+        return {'outerjoin': outerjoins, 'filter': filters[0]}
+    else:
+        return {'outerjoin': outerjoins, 'filter': conjunction(*filters)}
+
 
 class RecordAccessControl(object):
     """Base record access control class.
@@ -14,9 +45,21 @@ class RecordAccessControl(object):
     This is an abstract class. Use one of the derivative, or derivate
     your own class.
 
+    The alteration returned by :meth:`get_alteration` is computed for
+    each query, unless the class overrides :meth:`cache_key` to make
+    it cacheable. A cached alteration must only depend on `op`,
+    `item_type`, `model_class` and on the value returned by
+    :meth:`cache_key`. The single record queries of
+    :class:`woodbox.record_api.RecordAPI` (GET, PATCH and DELETE) are
+    also baked per cached alteration (see :meth:`bake`); list queries
+    only reuse the alteration.
+
     """
     __metaclass__ = ABCMeta
 
+    # Cache of (access control, op, key, item_type, model_class) -> alteration.
+    plan_cache = TTLCache(maxsize=10000, ttl=60)
+
     def __init__(self, *args, **kwargs):
         pass
 
@@ -26,10 +69,67 @@ class RecordAccessControl(object):
             query = query.outerjoin(j['table'], j['on'])
         return query.filter(alter['filter'])
 
+    def cache_key(self, op, user):
+        """Return a hashable value identifying the alteration for `user`.
+
+        Return None if the alteration cannot be cached, for example
+        because it depends on the request or on the database. This is
+        the default.
+        """
+        return None
+
+    def get_plan(self, op, user, item_type, model_class):
+        """Return a (key, alteration) pair, where key identifies the alteration.
+
+        The key is None if the alteration is not cached.
+        """
+        cache_key = self.cache_key(op, user)
+        if cache_key is None:
+            return None, self.get_alteration(op, user, item_type, model_class)
+        key = (self, op, cache_key, item_type, model_class)
+        alter = self.plan_cache.get(key)
+        if alter is None:
+            alter = self.get_alteration(op, user, item_type, model_class)
+            self.plan_cache.set(key, alter)
+        return key, alter
+
     def alter_query(self, op, query, user, item_type, model_class):
-        alter = self.get_alteration(op, user, item_type, model_class)
+        key, alter = self.get_plan(op, user, item_type, model_class)
         return self._alter_query(query, alter)
 
+    def denies(self, op, user, item_type, model_class):
+        """Return True if the alteration filters out all records, so that the query can be skipped."""
+        key, alter = self.get_plan(op, user, item_type, model_class)
+        return isinstance(alter['filter'], False_)
+
+    def permits(self, op, user, item_type, model_class, item_id):
+        """Tell if `user` may access the record `item_id` without querying it.
+
+        Return True or False if the answer is known, None if the
+        altered query must be run to know it.
+        """
+        key, alter = self.get_plan(op, user, item_type, model_class)
+        if isinstance(alter['filter'], True_):
+            return True
+        elif isinstance(alter['filter'], False_):
+            return False
+        else:
+            return None
+
+    def bake(self, baked_query, op, user, item_type, model_class):
+        """Add the alteration to a :class:`sqlalchemy.ext.baked.BakedQuery`.
+
+        The query and its compiled SQL are cached by the bakery for
+        each alteration key. If the alteration is not cached, the query
+        is spoiled, so that the alteration is applied to each query.
+        """
+        key, alter = self.get_plan(op, user, item_type, model_class)
+        if key is None:
+            baked_query.spoil()
+            baked_query.add_criteria(lambda q: self._alter_query(q, alter))
+        else:
+            baked_query.add_criteria(lambda q: self._alter_query(q, alter), *key)
+
     @abstractmethod
     def get_alteration(self, op, user, item_type, model_class):
         return {'outerjoin': [], 'filter': true()}
@@ -42,14 +142,23 @@ class And(RecordAccessControl):
             self.operands = args
         super(And, self).__init__(*args, **kwargs);
 
+    def cache_key(self, op, user):
+        keys = tuple(ac.cache_key(op, user) for ac in self.operands)
+        return None if any(k is None for k in keys) else keys
+
     def get_alteration(self, op, user, item_type, model_class):
-        outerjoins = []
-        filters = []
+        alters = (ac.get_alteration(op, user, item_type, model_class) for ac in self.operands)
+        return _combine(alters, and_, False_, True_)
+
+    def permits(self, op, user, item_type, model_class, item_id):
+        result = True
         for ac in self.operands:
-            alter = ac.get_alteration(op, user, item_type, model_class)
-            outerjoins += alter['outerjoin']
-            filters.append(alter['filter'])
-        return {'outerjoin': outerjoins, 'filter': and_(*filters)}
+            p = ac.permits(op, user, item_type, model_class, item_id)
+            if p is False:
+                return False
+            elif p is None:
+                result = None
+        return result
 
 
 class Or(RecordAccessControl):
@@ -59,14 +168,23 @@ class Or(RecordAccessControl):
             self.operands = args
         super(Or, self).__init__(*args, **kwargs);
 
+    def cache_key(self, op, user):
+        keys = tuple(ac.cache_key(op, user) for ac in self.operands)
+        return None if any(k is None for k in keys) else keys
+
     def get_alteration(self, op, user, item_type, model_class):
-        outerjoins = []
-        filters = []
+        alters = (ac.get_alteration(op, user, item_type, model_class) for ac in self.operands)
+        return _combine(alters, or_, True_, False_)
+
+    def permits(self, op, user, item_type, model_class, item_id):
+        result = False
         for ac in self.operands:
-            alter = ac.get_alteration(op, user, item_type, model_class)
-            outerjoins += alter['outerjoin']
-            filters.append(alter['filter'])
-        return {'outerjoin': outerjoins, 'filter': or_(*filters)}
+            p = ac.permits(op, user, item_type, model_class, item_id)
+            if p is True:
+                return True
+            elif p is None:
+                result = None
+        return result
 
 
 class OpSwitch(RecordAccessControl):
@@ -76,17 +194,36 @@ class OpSwitch(RecordAccessControl):
         self.delete_ac = delete_ac
         super(OpSwitch, self).__init__(*args, **kwargs);
 
-    def get_alteration(self, op, user, item_type, model_class):
-        outerjoins = []
-        filters = []
-        if op == 'read' and self.read_ac is not None:
-            return self.read_ac.get_alteration(op, user, item_type, model_class)
-        elif op == 'update' and self.update_ac is not None:
-            return self.update_ac.get_alteration(op, user, item_type, model_class)
-        elif op == 'delete' and self.delete_ac is not None:
-            return self.delete_ac.get_alteration(op, user, item_type, model_class)
+    def _get_ac(self, op):
+        if op == 'read':
+            return self.read_ac
+        elif op == 'update':
+            return self.update_ac
+        elif op == 'delete':
+            return self.delete_ac
+        else:
+            return None
+
+    def cache_key(self, op, user):
+        ac = self._get_ac(op)
+        if ac is None:
+            return ()
         else:
+            return ac.cache_key(op, user)
+
+    def get_alteration(self, op, user, item_type, model_class):
+        ac = self._get_ac(op)
+        if ac is None:
             return super(OpSwitch, self).get_alteration(op, user, item_type, model_class)
+        else:
+            return ac.get_alteration(op, user, item_type, model_class)
+
+    def permits(self, op, user, item_type, model_class, item_id):
+        ac = self._get_ac(op)
+        if ac is None:
+            return True
+        else:
+            return ac.permits(op, user, item_type, model_class, item_id)
 
 
 class IsOwner(RecordAccessControl):
@@ -95,6 +232,9 @@ class IsOwner(RecordAccessControl):
         self.owner_id_column = owner_id_column
         super(IsOwner, self).__init__(*args, **kwargs)
 
+    def cache_key(self, op, user):
+        return user
+
     def get_alteration(self, op, user, item_type, model_class):
         if user is None:
             return {'outerjoin': [], 'filter': false()}
@@ -109,6 +249,9 @@ class IsUser1(RecordAccessControl):
     This gives access to all records to user 1.
 
     """
+    def cache_key(self, op, user):
+        return user == 1
+
     def get_alteration(self, op, user, item_type, model_class):
         if user == 1:
             return {'outerjoin': [], 'filter': true()}
@@ -123,13 +266,11 @@ class HasRole(RecordAccessControl):
         self.roles = set(roles)
         super(HasRole, self).__init__(*args, **kwargs)
 
-    def get_alteration(self, op, user, item_type, model_class):
-        if user is None:
-            roles = {WBRoleModel.anonymous_role_name}
-        else:
-            user = WBUserModel.query.get(user)
-            roles = {r.rolename for r in user.roles}
+    def cache_key(self, op, user):
+        return bool(WBUserModel.get_roles(user).names & self.roles)
 
+    def get_alteration(self, op, user, item_type, model_class):
+        roles = WBUserModel.get_roles(user).names
         if roles & self.roles:
             return {'outerjoin': [], 'filter': true()}
         else:
@@ -137,14 +278,67 @@ class HasRole(RecordAccessControl):
 
 
 class InRecordACL(RecordAccessControl):
-    """Alter a query to return records having a RecordACLModel entry that matches the specified parameters."""
-    def get_alteration(self, op, user, item_type, model_class):
-        if user is None:
-            anonymous_role_id = WBRoleModel.get_anonymous_role_id()
-            user_roles = {anonymous_role_id}
+    """Alter a query to return records having a RecordACLModel entry that matches the specified parameters.
+
+    Keyword arguments:
+    strategy -- ``'join'`` (the default) to outer join the RecordACLModel
+                table, ``'exists'`` to filter with a correlated EXISTS
+                subquery, or ``'index'`` to use :attr:`RecordACLModel.index`.
+
+    The ``'exists'`` strategy does not duplicate records when several
+    roles of the user grant the permission.
+
+    The ``'index'`` strategy checks single records in memory, without
+    querying the RecordACLModel table. Lists of at most
+    :attr:`max_in_size` permitted records are filtered with an IN
+    clause; larger lists use the ``'exists'`` strategy.
+
+    """
+    strategies = ('join', 'exists', 'index')
+
+    max_in_size = 1000
+
+    def __init__(self, strategy='join', *args, **kwargs):
+        if strategy not in self.strategies:
+            raise ValueError(strategy)
+        self.strategy = strategy
+        super(InRecordACL, self).__init__(*args, **kwargs)
+
+    def cache_key(self, op, user):
+        if self.strategy == 'index':
+            return WBUserModel.get_roles(user).ids, RecordACLModel.index.version
         else:
-            user = WBUserModel.query.get(user)
-            user_roles = {r.id for r in user.roles}
+            return WBUserModel.get_roles(user).ids
+
+    def permits(self, op, user, item_type, model_class, item_id):
+        if self.strategy != 'index':
+            return super(InRecordACL, self).permits(op, user, item_type, model_class, item_id)
+        try:
+            record_id = int(item_id)
+        except ValueError:
+            return None
+        return RecordACLModel.index.permits(item_type, op, WBUserModel.get_roles(user).ids, record_id)
+
+    def get_alteration(self, op, user, item_type, model_class):
+        user_roles = WBUserModel.get_roles(user).ids
+
+        if self.strategy == 'index':
+            index = RecordACLModel.index
+            if index.count(item_type, op, user_roles) <= self.max_in_size:
+                ids = index.permitted_ids(item_type, op, user_roles)
+                return {
+                    'outerjoin': [],
+                    'filter': model_class.id.in_(ids) if ids else false()
+                }
+
+        if self.strategy in ('exists', 'index'):
+            return {
+                'outerjoin': [],
+                'filter': exists().where(and_(RecordACLModel.record_type == item_type,
+                                              RecordACLModel.permission == op,
+                                              RecordACLModel.user_role_id.in_(user_roles),
+                                              RecordACLModel.record_id == model_class.id))
+            }
 
         return {
             'outerjoin': [{
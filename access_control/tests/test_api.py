@@ -110,3 +110,35 @@ class ApiAccessTestCase(FlaskTestCase):
                 meth = getattr(self, action, None)
                 meth = acl.authorize(meth)
                 self.assertRaises(HTTPException, meth)
+
+    def test_replace_grants(self):
+        local_acl = Acl()
+        local_acl.grants({'user': {'TestResource': ['read']}})
+        with self.app.test_request_context('/'):
+            g.user = self.u3
+            get = local_acl.authorize(self.get)
+            post = local_acl.authorize(self.post)
+            self.assertTrue(get())
+            self.assertRaises(HTTPException, post)
+
+            local_acl.replace_grants({'user': {'TestResource': ['create']}})
+            self.assertTrue(post())
+            self.assertRaises(HTTPException, get)
+
+            local_acl.revoke('user', 'TestResource', 'create')
+            self.assertRaises(HTTPException, post)
+
+    def test_decision_table(self):
+        local_acl = Acl()
+        local_acl.grants({'a': {'R': ['read']}, 'b': {'R': ['update'], 'S': ['read']}})
+        decisions = local_acl.decisions
+        self.assertEqual(decisions.actions(['a', 'b'], 'R'), frozenset(['read', 'update']))
+        self.assertIs(decisions.actions(frozenset(['b', 'a']), 'R'),
+                      decisions.actions(['a', 'b'], 'R'))
+        self.assertEqual(decisions.actions([], 'R'), frozenset())
+        self.assertTrue(local_acl.check_any(['c', 'b'], 'S', 'read'))
+        self.assertFalse(local_acl.check('a', 'S', 'read'))
+
+        local_acl.grant('a', 'S', 'read')
+        self.assertIsNot(local_acl.decisions, decisions)
+        self.assertTrue(local_acl.check('a', 'S', 'read'))
@@ -3,9 +3,11 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import unittest
 
+from sqlalchemy import true
 from sqlalchemy.exc import IntegrityError
 
-from woodbox.access_control.record import And, Or, OpSwitch, IsOwner, IsUser1, HasRole, InRecordACL
+from woodbox.access_control.record import (And, Or, OpSwitch, IsOwner, IsUser1, HasRole, InRecordACL,
+                                           RecordAccessControl)
 from woodbox.db import db
 from woodbox.models.record_acl_model import RecordACLModel, make_record_acl
 from woodbox.models.user_model import WBRoleModel, WBUserModel
@@ -415,3 +417,110 @@ class RecordAccessTestCase(FlaskTestCase):
             self.assertIn(self.d2, ids)
             self.assertNotIn(self.d3, ids)
             self.assertNotIn(self.d4, ids)
+
+    def test_plan_cache(self):
+        with self.app.test_request_context('/'):
+            class CountingInRecordACL(InRecordACL):
+                calls = 0
+                def get_alteration(self, *args):
+                    CountingInRecordACL.calls += 1
+                    return super(CountingInRecordACL, self).get_alteration(*args)
+
+            ac = Or(IsUser1(), CountingInRecordACL())
+            for u in [self.u2, self.u2, self.u3, self.u3]:
+                query = ac.alter_query('read', MyModel.query, u, 'My', MyModel)
+                self.assertEqual(len(query.all()), 4)
+            # One alteration per role set.
+            self.assertEqual(CountingInRecordACL.calls, 2)
+
+            query = ac.alter_query('update', MyModel.query, self.u2, 'My', MyModel)
+            self.assertEqual({i.id for i in query}, {self.d3, self.d4})
+            self.assertEqual(CountingInRecordACL.calls, 3)
+
+    def test_plan_cache_opt_in(self):
+        with self.app.test_request_context('/'):
+            class CountingAccessControl(RecordAccessControl):
+                calls = 0
+                def get_alteration(self, *args):
+                    CountingAccessControl.calls += 1
+                    return {'outerjoin': [], 'filter': true()}
+
+            # Classes that do not define cache_key() are not cached,
+            # nor are the combinations including them.
+            for ac in (CountingAccessControl(), And(IsUser1(), CountingAccessControl())):
+                CountingAccessControl.calls = 0
+                for u in [self.u1, self.u1]:
+                    ac.alter_query('read', MyModel.query, u, 'My', MyModel)
+                self.assertEqual(CountingAccessControl.calls, 2)
+
+    def test_constant_folding(self):
+        with self.app.test_request_context('/'):
+            ac = Or(IsUser1(), InRecordACL())
+            alter = ac.get_alteration('read', self.u1, 'My', MyModel)
+            self.assertEqual(alter['outerjoin'], [])
+            self.assertFalse(ac.denies('read', self.u1, 'My', MyModel))
+            alter = ac.get_alteration('read', self.u2, 'My', MyModel)
+            self.assertEqual(len(alter['outerjoin']), 1)
+
+            ac = And(IsUser1(), InRecordACL())
+            self.assertTrue(ac.denies('read', self.u2, 'My', MyModel))
+            self.assertEqual(ac.get_alteration('read', self.u2, 'My', MyModel)['outerjoin'], [])
+
+    def test_join_deduplication(self):
+        with self.app.test_request_context('/'):
+            ac = And(InRecordACL(), Or(IsOwner(), InRecordACL()))
+            alter = ac.get_alteration('update', self.u2, 'My', MyModel)
+            self.assertEqual(len(alter['outerjoin']), 1)
+            query = ac.alter_query('update', MyModel.query, self.u2, 'My', MyModel)
+            self.assertEqual(sorted(i.id for i in query), [self.d3, self.d4])
+
+    def test_in_record_acl_exists(self):
+        with self.app.test_request_context('/'):
+            for user, op, expected in [(self.u1, 'update', [self.d1, self.d2, self.d3, self.d4]),
+                                       (self.u2, 'update', [self.d3, self.d4]),
+                                       (self.u3, 'update', []),
+                                       (None, 'read', [self.d3, self.d4])]:
+                ac = InRecordACL(strategy='exists')
+                query = ac.alter_query(op, MyModel.query, user, 'My', MyModel)
+                self.assertEqual(sorted(i.id for i in query), expected)
+                self.assertEqual(ac.get_alteration(op, user, 'My', MyModel)['outerjoin'], [])
+
+            self.assertRaises(ValueError, InRecordACL, strategy='bitmap')
+
+    def test_in_record_acl_index(self):
+        with self.app.test_request_context('/'):
+            default_max_in_size = InRecordACL.max_in_size
+            for max_in_size in [1000, 0]:
+                InRecordACL.max_in_size = max_in_size
+                try:
+                    for user, op, expected in [(self.u1, 'update', [self.d1, self.d2, self.d3, self.d4]),
+                                               (self.u2, 'update', [self.d3, self.d4]),
+                                               (self.u3, 'update', []),
+                                               (None, 'read', [self.d3, self.d4])]:
+                        ac = InRecordACL(strategy='index')
+                        query = ac.alter_query(op, MyModel.query, user, 'My', MyModel)
+                        self.assertEqual(sorted(i.id for i in query), expected)
+                        for d in [self.d1, self.d2, self.d3, self.d4]:
+                            self.assertEqual(ac.permits(op, user, 'My', MyModel, str(d)), d in expected)
+                finally:
+                    InRecordACL.max_in_size = default_max_in_size
+
+            # Changes are applied after commit.
+            ac = InRecordACL(strategy='index')
+            acl = RecordACLModel(record_type='My', record_id=self.d1, user_role_id=self.r2, permission='update')
+            db.session.add(acl)
+            db.session.flush()
+            self.assertFalse(ac.permits('update', self.u2, 'My', MyModel, self.d1))
+            db.session.commit()
+            self.assertTrue(ac.permits('update', self.u2, 'My', MyModel, self.d1))
+            query = ac.alter_query('update', MyModel.query, self.u2, 'My', MyModel)
+            self.assertEqual(sorted(i.id for i in query), [self.d1, self.d3, self.d4])
+
+            db.session.delete(acl)
+            db.session.commit()
+            self.assertFalse(ac.permits('update', self.u2, 'My', MyModel, self.d1))
+
+            self.assertIsNone(ac.permits('update', self.u2, 'My', MyModel, 'abc'))
+            self.assertIsNone(Or(IsOwner(), ac).permits('update', self.u2, 'My', MyModel, self.d1))
+            self.assertTrue(Or(IsOwner(), ac).permits('update', self.u2, 'My', MyModel, self.d3))
+            self.assertFalse(And(IsOwner(), ac).permits('update', self.u2, 'My', MyModel, self.d1))
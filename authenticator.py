@@ -1,59 +1,139 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import calendar
+import re
+import time
 import urllib
 import urlparse
 
-from datetime import timedelta
 from functools import wraps
 from hashlib import sha256
 from hmac import new as hmac_new
+from tempfile import SpooledTemporaryFile
 
-import arrow
 import six
 
-from flask import request, g
+from flask import current_app, request, g
+from flask_restful import abort
 
 from twisted.logger import Logger
 log = Logger()
 
 from .models.session_model import WBSessionModel
+from .stateless_session import StatelessSession
+from .utils.compare_digest import compare_digest
 
-try:
-    from hmac import compare_digest
-except ImportError:
-    def compare_digest(a, b):
-        l = min(len(a), len(b))
 
-        result = True
-        for i in range(0, l):
-            result = result and (a[i] == b[i]);
+def _utf8(s):
+    return s.encode('utf-8') if isinstance(s, six.text_type) else s
 
-        if len(a) != len(b):
-            result = False
 
-        return result
+class HMACAuthenticator(object):
+    """Analyze a request and find from which user it originates.
 
+    To reject replayed requests, set :attr:`nonce_store` to an instance
+    of a :class:`woodbox.nonce_store.NonceStore` subclass.
 
-class HMACAuthenticator(object):
-    """Analyze a request and find from which user it originates."""
+    The request body is hashed while it is read. Bodies larger than
+    the ``WOODBOX_BODY_SPOOL_SIZE`` configuration value (default to 1
+    MiB) are spooled to a temporary file, and bodies larger than
+    ``MAX_CONTENT_LENGTH`` are rejected with a 413 error.
+
+    Applications made by :func:`woodbox.create_app` authenticate every
+    request once in a ``before_request`` hook (see :meth:`init_app`).
+    Set ``WOODBOX_AUTHENTICATE_BEFORE_REQUEST`` to False to only
+    authenticate requests to views decorated with :meth:`authenticate`.
+    ``WOODBOX_REJECT_INVALID_AUTHORIZATION`` (default True) tells the
+    hook to reject malformed, expired or tampered authorizations.
+    """
+
+    # In seconds.
+    max_request_age = 5*60
+
+    nonce_store = None
+
+    body_chunk_size = 64 * 1024
+
+    default_signed_headers = ('content-type', 'host', 'x-woodbox-content-sha256', 'x-woodbox-timestamp')
+
+    # Signatures are lowercase hexadecimal SHA-256 HMACs.
+    signature_format = re.compile(r'\A[0-9a-f]{64}\Z')
+
+    @staticmethod
+    def keyed_hmac(secret):
+        """Return an HMAC-SHA256 object keyed with `secret`.
+
+        Pass it as the `signer` of :meth:`get_authorization_headers` to
+        avoid deriving the key state on each call.
+        """
+        return hmac_new(secret.encode('utf-8'), digestmod=sha256)
+
+    @staticmethod
+    def format_timestamp(t):
+        """Format `t` (seconds since the epoch) as an x-woodbox-timestamp value."""
+        return time.strftime('%Y%m%dT%H%M%SZ', time.gmtime(t))
+
+    @staticmethod
+    def parse_timestamp(timestamp):
+        """Parse an x-woodbox-timestamp value and return it in seconds since the epoch.
+
+        The accepted format is ``YYYYMMDDTHHMMSS`` followed by nothing
+        (UTC), ``Z`` or a ``+HHMM``/``-HHMM`` UTC offset. Raise ValueError
+        if `timestamp` does not match.
+        """
+        if len(timestamp) < 15 or timestamp[8] != 'T':
+            raise ValueError(timestamp)
+        t = calendar.timegm((int(timestamp[0:4]), int(timestamp[4:6]), int(timestamp[6:8]),
+                             int(timestamp[9:11]), int(timestamp[11:13]), int(timestamp[13:15])))
+        tz = timestamp[15:]
+        if tz == '' or tz == 'Z':
+            return t
+        if len(tz) != 5 or tz[0] not in '+-':
+            raise ValueError(timestamp)
+        offset = 3600*int(tz[1:3]) + 60*int(tz[3:5])
+        return t - offset if tz[0] == '+' else t + offset
+
+    @staticmethod
+    def canonical_request(method, path, args, headers, signed_headers, payload_hash):
+        """Build the canonical request, as an UTF-8 encoded string.
+
+        Arguments:
+        method -- the HTTP method
+        path -- the URL path, unquoted
+        args -- list of (name, value) query string parameters, in any order
+        headers -- dict of lowercase header names to values
+        signed_headers -- sorted list of the lowercase names of the signed headers
+        payload_hash -- hex SHA-256 digest of the body
+        """
+        if args:
+            # Sort by name, then by value.
+            args = sorted((_utf8(k), _utf8(v)) for k, v in args)
+        canonical_request = '\n'.join([method.strip(),
+                                       urllib.quote(path.strip()),
+                                       urllib.urlencode(args) if args else '',
+                                       '\n'.join([h + ':' + headers[h] for h in signed_headers]),
+                                       ';'.join(signed_headers),
+                                       payload_hash])
+        return canonical_request.encode('utf-8')
+
+    @staticmethod
+    def string_to_sign(timestamp, canonical_request):
+        return 'WOODBOX-HMAC-SHA256\n' + timestamp + '\n' + sha256(canonical_request).hexdigest()
 
     @staticmethod
     def get_authorization_headers(session_id, secret, path,
                                   query_string=None, method='GET',
                                   content_type='', body='',
-                                  host='localhost'):
+                                  host='localhost', signer=None):
 
-        canonical_uri = urllib.quote(path.strip())
         if query_string is not None:
-            canonical_query_string = urlparse.parse_qsl(query_string, True, True)
-            canonical_query_string.sort() # will sort by name, then by value
-            canonical_query_string = urllib.urlencode(canonical_query_string)
+            args = urlparse.parse_qsl(query_string, True, True)
         else:
-            canonical_query_string = ''
+            args = []
 
         payload_hash = sha256(body).hexdigest()
-        now = arrow.utcnow().format("YYYYMMDDTHHmmssZ")
+        now = HMACAuthenticator.format_timestamp(time.time())
 
         headers = {
             'content-type': content_type,
@@ -62,25 +142,20 @@ class HMACAuthenticator(object):
             'x-woodbox-timestamp': now
         }
 
-        signed_headers = sorted(['content-type', 'host','x-woodbox-content-sha256','x-woodbox-timestamp'])
-
-        canonical_headers = []
-        for h in signed_headers:
-            canonical_headers.append(h+':'+headers[h])
-        canonical_headers = '\n'.join(canonical_headers).encode('utf-8')
-        signed_headers = ';'.join(signed_headers)
-        canonical_request = '\n'.join([method, path,
-                                       canonical_query_string,
-                                       canonical_headers,
-                                       signed_headers, payload_hash])
-
-        string_to_sign = '\n'.join(['WOODBOX-HMAC-SHA256', now, sha256(canonical_request).hexdigest()])
-        signing_key = secret.encode('utf-8')
-        signature = hmac_new(signing_key, string_to_sign, sha256).hexdigest()
+        signed_headers = HMACAuthenticator.default_signed_headers
+        canonical_request = HMACAuthenticator.canonical_request(method, path, args,
+                                                                headers, signed_headers,
+                                                                payload_hash)
+        string_to_sign = HMACAuthenticator.string_to_sign(now, canonical_request)
+        if signer is None:
+            signer = HMACAuthenticator.keyed_hmac(secret)
+        mac = signer.copy()
+        mac.update(string_to_sign)
+        signature = mac.hexdigest()
 
         auth = {
             'Credential': session_id,
-            'SignedHeaders': signed_headers,
+            'SignedHeaders': ';'.join(signed_headers),
             'Signature': signature
         }
         auth = [k+'='+v for k,v in auth.iteritems()]
@@ -95,6 +170,43 @@ class HMACAuthenticator(object):
 
         return auth_headers
 
+    @staticmethod
+    def hash_request_body():
+        """Return the hex SHA-256 digest of the request body.
+
+        The body is read in chunks and copied to a spooled temporary
+        file, which then replaces ``request.stream`` so that the view
+        can read the body again.
+        """
+        cached_data = getattr(request, '_cached_data', None)
+        if cached_data is not None:
+            return sha256(cached_data).hexdigest()
+
+        max_length = current_app.config.get('MAX_CONTENT_LENGTH')
+        if max_length is not None and (request.content_length or 0) > max_length:
+            abort(413)
+
+        digest = sha256()
+        spool = SpooledTemporaryFile(max_size=current_app.config.get('WOODBOX_BODY_SPOOL_SIZE', 1024*1024))
+        length = 0
+        stream = request.stream
+        while True:
+            chunk = stream.read(HMACAuthenticator.body_chunk_size)
+            if not chunk:
+                break
+            length += len(chunk)
+            if max_length is not None and length > max_length:
+                spool.close()
+                abort(413)
+            digest.update(chunk)
+            spool.write(chunk)
+        spool.seek(0)
+
+        # Werkzeug's stream is a cached property: bypass it the same way
+        # Werkzeug does after parsing form data.
+        request.__dict__['stream'] = spool
+        return digest.hexdigest()
+
     @staticmethod
     def parse_authorization_header(header):
         method, _, args = header.partition(' ')
@@ -108,7 +220,24 @@ class HMACAuthenticator(object):
 
     @staticmethod
     def verify(algo, auth, headers):
+        """Verify the request signature and set g.user accordingly.
+
+        Return True if the request is authenticated. See
+        :meth:`check_request` for the expected headers.
         """
+        checked = HMACAuthenticator.check_request(algo, auth, headers)
+        if checked is None:
+            return False
+        return HMACAuthenticator.check_signature(headers, *checked)
+
+    @staticmethod
+    def check_request(algo, auth, headers):
+        """Check everything that can be checked without loading the session.
+
+        On failure, set g.user and g.user_reason and return None.
+        Otherwise, return a (credential, signed_headers, signature,
+        request_time, payload_hash) tuple to pass to :meth:`check_signature`.
+
         Expected headers:
 
         Content-Type: application/vnd.api+json
@@ -120,7 +249,7 @@ class HMACAuthenticator(object):
         if algo.lower() not in frozenset(['hmac-sha256']):
             g.user = None
             g.user_reason = 'Unknown authentication method: ' + algo
-            return False
+            return None
 
         # Check that we have all the required authentication parameters.
         try:
@@ -131,7 +260,12 @@ class HMACAuthenticator(object):
         except KeyError as e:
             g.user = None
             g.user_reason = 'Missing parameter: {}'.format(e.args[0])
-            return False
+            return None
+
+        if not HMACAuthenticator.signature_format.match(signature):
+            g.user = None
+            g.user_reason = 'Invalid signature.'
+            return None
 
         # Required headers are the headers that MUST be included in the canonical headers.
         required_headers = set(['host', 'x-woodbox-content-sha256', 'x-woodbox-timestamp'])
@@ -146,77 +280,87 @@ class HMACAuthenticator(object):
             g.user = None
             missing = (required_headers - set(signed_headers))
             g.user_reason = 'Some required headers were not signed: ' + ', '.join(missing)
-            return False
+            return None
 
         # Check that all signed headers are part of the request.
         missing_headers = set(signed_headers) - set(six.iterkeys(headers))
         if missing_headers:
             g.user = None
             g.user_reason = 'Missing headers: ' + ', '.join(missing_headers)
-            return False
+            return None
 
         # Check the age of the request. It must not be older than 5 minutes.
-        request_time = arrow.get(headers['x-woodbox-timestamp'], ["YYYYMMDDTHHmmssZ", "YYYYMMDDTHHmmss"])
-        now = arrow.utcnow()
-        max_age = timedelta(minutes=5)
-        if abs(request_time - now) > max_age:
+        timestamp = headers['x-woodbox-timestamp']
+        try:
+            request_time = HMACAuthenticator.parse_timestamp(timestamp)
+        except ValueError:
+            g.user = None
+            g.user_reason = 'Invalid timestamp.'
+            return None
+        if abs(request_time - time.time()) > HMACAuthenticator.max_request_age:
             g.user = None
             g.user_reason = 'Request is too old.'
-            return False
-
-        # FIXME Implement a nonce to prevent replay attacks.
+            return None
 
         # Check the content hash.
-        payload_hash = sha256(request.data).hexdigest()
+        payload_hash = HMACAuthenticator.hash_request_body()
         if payload_hash != headers['x-woodbox-content-sha256']:
             g.user = None
             g.user_reason = 'Content hash does not match.'
-            return False
+            return None
+
+        return credential, signed_headers, signature, request_time, payload_hash
+
+    @staticmethod
+    def check_signature(headers, credential, signed_headers, signature, request_time, payload_hash):
+        """Load the session referenced by `credential` and check the request signature.
 
-        # Load the session
-        session = WBSessionModel.query.filter_by(session_id=credential).first()
+        Set g.user and g.user_reason and return True if the signature matches.
+        """
+        # Load the session. Stateless credentials are checked without
+        # accessing the database.
+        if StatelessSession.is_stateless(credential):
+            session = StatelessSession.get_credentials(credential)
+        else:
+            session = WBSessionModel.get_credentials(credential)
         if not session:
             g.user = None
             g.user_reason = 'Invalid credential.'
             return False
 
-        method = request.method.strip()
-        canonical_uri = urllib.quote(request.path.strip())
-
-        # Build the canonical query string
-        canonical_query_string = []
-        args = request.args.items(multi=True)
-        args.sort()
-        canonical_query_string = urllib.urlencode(args)
-
-        # Build the canonical headers string.
-        canonical_headers = []
-        for h in signed_headers:
-            canonical_headers.append(h+':'+headers[h])
-        canonical_headers = '\n'.join(canonical_headers).encode('utf-8')
-
-        signed_headers = ';'.join(signed_headers)
-        canonical_request = '\n'.join([method, canonical_uri,
-                                       canonical_query_string, canonical_headers, signed_headers,
-                                       payload_hash])
-
-        timestamp = headers['x-woodbox-timestamp']
-
-        string_to_sign = '\n'.join(['WOODBOX-HMAC-SHA256', timestamp, sha256(canonical_request).hexdigest()])
-        signing_key = session.secret.encode('utf-8')
-        computed_signature = hmac_new(signing_key, string_to_sign, sha256).hexdigest()
+        canonical_request = HMACAuthenticator.canonical_request(request.method, request.path,
+                                                                request.args.items(multi=True),
+                                                                headers, signed_headers,
+                                                                payload_hash)
+        string_to_sign = HMACAuthenticator.string_to_sign(headers['x-woodbox-timestamp'],
+                                                          canonical_request)
+        mac = session.signer.copy()
+        mac.update(string_to_sign)
+        computed_signature = mac.hexdigest()
 
         # Compare our signature with the signature in the request.
-        if compare_digest(signature.encode('ascii', 'ignore'), computed_signature.encode('ascii', 'ignore')):
-            g.user = session.user_id
-            g.user_reason = 'Authenticated'
-            success = True
+        # check_request() made sure that the signature is ASCII.
+        if compare_digest(signature.encode('ascii'), computed_signature.encode('ascii')):
+            # Only valid signatures are recorded, so that forged requests
+            # cannot fill the nonce store. The nonce is made from our
+            # signature, so that it does not depend on how the client
+            # wrote its signature.
+            nonce_store = HMACAuthenticator.nonce_store
+            if nonce_store is not None and not nonce_store.add(credential + ':' + computed_signature,
+                                                               request_time):
+                g.user = None
+                g.user_reason = 'Request was already received.'
+                success = False
+            else:
+                g.user = session.user_id
+                g.user_reason = 'Authenticated'
+                success = True
         else:
             g.user = None
             g.user_reason = 'Signature do not match'
             log.debug("Authentication failure: signature do not match.\nExpected signature: {expected}\nComputed signature: {computed}\n\nString to sign:\n{sts}\n\nCanonical request:\n{cr}",
-                      expected=signature.encode('ascii', 'ignore'),
-                      computed=computed_signature.encode('ascii', 'ignore'),
+                      expected=signature,
+                      computed=computed_signature,
                       sts=string_to_sign,
                       cr=canonical_request)
             success = False
@@ -225,21 +369,61 @@ class HMACAuthenticator(object):
         return success
 
     @staticmethod
-    def authenticate(f):
-        @wraps(f)
-        def wrapper(*args, **kwargs):
-            headers = dict()
-            for h in six.iterkeys(request.headers):
-                headers[h.lower().strip()] = request.headers[h].strip()
+    def authenticate_request(reject_invalid=False):
+        """Authenticate the current request and set g.user and g.user_reason.
 
-            g.user = None
-            g.user_reason = "No valid authorization header."
+        The request is only authenticated once: later calls return
+        the cached g.user.
+
+        If `reject_invalid` is True, requests having a malformed, expired
+        or tampered authorization are rejected with a 401 error before
+        the session is loaded.
+        """
+        if request.environ.get('woodbox.authenticated'):
+            return g.user
+        request.environ['woodbox.authenticated'] = True
+
+        g.user = None
+        g.user_reason = "No valid authorization header."
+
+        authorization = request.headers.get('Authorization')
+        if authorization is None:
+            return None
+
+        method, auth = HMACAuthenticator.parse_authorization_header(authorization.strip())
+        if method[:8].lower() != 'woodbox-':
+            return None
+
+        headers = dict()
+        for h, v in six.iteritems(request.headers):
+            headers[h.lower().strip()] = v.strip()
+
+        checked = HMACAuthenticator.check_request(method[8:].lower(), auth, headers)
+        if checked is None:
+            if reject_invalid:
+                abort(401, errors=[g.user_reason])
+        else:
+            HMACAuthenticator.check_signature(headers, *checked)
+
+        return g.user
+
+    @staticmethod
+    def init_app(app, reject_invalid=True):
+        """Authenticate all requests to `app` before they are dispatched.
+
+        Views decorated with :meth:`authenticate` reuse the result
+        instead of authenticating the request again.
+        """
+        def authenticate_before_request():
+            HMACAuthenticator.authenticate_request(reject_invalid)
 
-            if 'authorization' in headers:
-                method, auth = HMACAuthenticator.parse_authorization_header(headers['authorization'])
-                if method[:8].lower() == 'woodbox-':
-                    HMACAuthenticator.verify(method[8:].lower(), auth, headers)
+        app.before_request(authenticate_before_request)
 
+    @staticmethod
+    def authenticate(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            HMACAuthenticator.authenticate_request()
             return f(*args, **kwargs)
 
         return wrapper
@@ -0,0 +1,73 @@
+# -*- coding: utf-8 -*-
+"""Compare the shared canonical request builder with the code it replaced.
+
+Run from the parent directory of woodbox::
+
+    python -m woodbox.benchmarks.canonical_request
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+import timeit
+import urllib
+
+from hashlib import sha256
+
+import arrow
+
+from ..authenticator import HMACAuthenticator
+
+
+def legacy(method, path, args, headers, signed_headers, payload_hash, timestamp):
+    """The string to sign computation of HMACAuthenticator.verify, before the canonicalizer."""
+    request_time = arrow.get(timestamp, ["YYYYMMDDTHHmmssZ", "YYYYMMDDTHHmmss"])
+    abs(request_time - arrow.utcnow())
+
+    canonical_uri = urllib.quote(path.strip())
+    args = list(args)
+    args.sort()
+    canonical_query_string = urllib.urlencode(args)
+    canonical_headers = []
+    for h in signed_headers:
+        canonical_headers.append(h+':'+headers[h])
+    canonical_headers = '\n'.join(canonical_headers).encode('utf-8')
+    signed_headers = ';'.join(signed_headers)
+    canonical_request = '\n'.join([method.strip(), canonical_uri,
+                                   canonical_query_string, canonical_headers, signed_headers,
+                                   payload_hash])
+    return '\n'.join(['WOODBOX-HMAC-SHA256', timestamp, sha256(canonical_request).hexdigest()])
+
+
+def canonicalizer(method, path, args, headers, signed_headers, payload_hash, timestamp):
+    abs(HMACAuthenticator.parse_timestamp(timestamp) - time.time())
+
+    canonical_request = HMACAuthenticator.canonical_request(method, path, args, headers,
+                                                            signed_headers, payload_hash)
+    return HMACAuthenticator.string_to_sign(timestamp, canonical_request)
+
+
+def main(n=20000):
+    payload_hash = sha256(b'').hexdigest()
+    timestamp = HMACAuthenticator.format_timestamp(time.time())
+    headers = {
+        'content-type': 'application/vnd.api+json',
+        'host': 'localhost',
+        'x-woodbox-content-sha256': payload_hash,
+        'x-woodbox-timestamp': timestamp,
+    }
+    request_args = ('GET', '/blog-posts', [('page[size]', '20'), ('author', 'alice')],
+                    headers, sorted(headers), payload_hash, timestamp)
+
+    assert legacy(*request_args) == canonicalizer(*request_args)
+
+    results = []
+    for name, f in [('legacy', legacy), ('canonicalizer', canonicalizer)]:
+        t = min(timeit.repeat(lambda: f(*request_args), number=n, repeat=3))
+        results.append(t)
+        print('{:<14} {:8.2f} us/request'.format(name, 1e6 * t / n))
+
+    print('speedup: {:.1f}x'.format(results[0] / results[1]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""Compare signing with a fresh HMAC key and with a precomputed key state.
+
+Run from the parent directory of woodbox::
+
+    python -m woodbox.benchmarks.hmac_key_state
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import binascii
+import os
+import timeit
+
+from hashlib import sha256
+from hmac import new as hmac_new
+
+
+def main(n=100000):
+    secret = binascii.hexlify(os.urandom(32))
+    string_to_sign = '\n'.join(['WOODBOX-HMAC-SHA256', '20160122T211203Z', sha256(b'').hexdigest()])
+    signer = hmac_new(secret, digestmod=sha256)
+
+    def fresh_key():
+        return hmac_new(secret, string_to_sign, sha256).hexdigest()
+
+    def key_state_copy():
+        mac = signer.copy()
+        mac.update(string_to_sign)
+        return mac.hexdigest()
+
+    assert fresh_key() == key_state_copy()
+
+    results = []
+    for name, f in [('fresh key', fresh_key), ('key state copy', key_state_copy)]:
+        t = min(timeit.repeat(f, number=n, repeat=3))
+        results.append(t)
+        print('{:<16} {:8.2f} us/signature {:10.0f} signatures/s'.format(name, 1e6 * t / n, n / t))
+
+    print('saving: {:.2f} us/signature ({:.0f}%)'.format(1e6 * (results[0] - results[1]) / n,
+                                                         100 * (results[0] - results[1]) / results[0]))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""Compare the pure Python pbkdf2_hmac fallback with hashlib's implementation.
+
+Run from the parent directory of woodbox::
+
+    python -m woodbox.benchmarks.pbkdf2_hmac
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import hashlib
+import timeit
+
+from woodbox.utils.pbkdf2_hmac import _pbkdf2_hmac_py
+
+
+def main(iterations=20000, login_iterations=200000):
+    implementations = [('python fallback', _pbkdf2_hmac_py)]
+    if hasattr(hashlib, 'pbkdf2_hmac'):
+        implementations.append(('hashlib', hashlib.pbkdf2_hmac))
+    else:
+        print('hashlib.pbkdf2_hmac is not available on this interpreter.')
+
+    results = []
+    for hash_name in [str('sha1'), str('sha256')]:
+        for name, f in implementations:
+            t = min(timeit.repeat(lambda: f(hash_name, b'password', b'salt', iterations),
+                                  number=1, repeat=5))
+            results.append(t)
+            print('{:<7} {:<16} {:8.3f} us/iteration {:8.0f} ms/login'.format(
+                hash_name, name, 1e6 * t / iterations, 1e3 * t * login_iterations / iterations))
+        if len(implementations) == 2:
+            print('{:<7} fallback / hashlib time ratio: {:.2f}'.format(hash_name, results[-2] / results[-1]))
+
+
+if __name__ == '__main__':
+    main()
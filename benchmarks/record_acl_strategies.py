@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""Compare the join and exists strategies of InRecordACL on a large ACL table.
+
+The SQLite database is built in a temporary file, with `records`
+records and `roles` * 2 permissions ACL rows per record (1M rows by
+default). Building it takes a while.
+
+Run from the parent directory of woodbox::
+
+    python -m woodbox.benchmarks.record_acl_strategies [records]
+"""
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import sys
+import tempfile
+import time
+
+from flask import Flask
+
+from ..access_control.record import InRecordACL
+from ..db import db
+from ..models.record_acl_model import RecordACLModel
+from ..models.user_model import WBRoleModel, WBUserModel
+
+
+class BenchmarkRecordModel(db.Model):
+    id = db.Column(db.Integer, db.Sequence('benchmark_record_model_id_seq'), primary_key=True)
+    title = db.Column(db.String(256), nullable=True)
+
+
+def populate(records, roles, batch_size=10000):
+    all_roles = [WBRoleModel(rolename='role{}'.format(i)) for i in range(roles)]
+    db.session.add_all(all_roles)
+    db.session.flush()
+    role_ids = [r.id for r in all_roles]
+    user = WBUserModel(username='user', password='user', roles=all_roles[:3])
+    db.session.add(user)
+    db.session.commit()
+
+    db.session.execute(BenchmarkRecordModel.__table__.insert(),
+                       [{'id': i, 'title': 'record {}'.format(i)} for i in range(1, records + 1)])
+
+    insert = RecordACLModel.__table__.insert()
+    rows = []
+    for i in range(1, records + 1):
+        for role_id in role_ids:
+            # Each role can read every record, and update or delete it
+            # depending on the parity of the record and role ids.
+            rows.append({'record_type': 'Benchmark', 'record_id': i,
+                         'user_role_id': role_id, 'permission': 'read'})
+            if (i + role_id) % 2 == 0:
+                rows.append({'record_type': 'Benchmark', 'record_id': i,
+                             'user_role_id': role_id, 'permission': 'update'})
+            else:
+                rows.append({'record_type': 'Benchmark', 'record_id': i,
+                             'user_role_id': role_id, 'permission': 'delete'})
+        if len(rows) >= batch_size:
+            db.session.execute(insert, rows)
+            rows = []
+    if rows:
+        db.session.execute(insert, rows)
+    db.session.commit()
+    db.session.execute('ANALYZE')
+    return user.id
+
+
+def timed(f, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        result = f()
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def main(records=100000, roles=5):
+    path = os.path.join(tempfile.mkdtemp(), 'record_acl.sqlite')
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite+pysqlite:///' + path
+    app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    app.config['WOODBOX_PASSWORD_ITERATIONS'] = 1000
+    db.init_app(app)
+
+    with app.test_request_context('/'):
+        db.initialize()
+        start = time.time()
+        user = populate(records, roles)
+        print('{} ACL rows inserted in {:.1f} s'.format(RecordACLModel.query.count(), time.time() - start))
+
+        middle = records // 2
+        for strategy in InRecordACL.strategies:
+            ac = InRecordACL(strategy=strategy)
+
+            def list_records():
+                query = ac.alter_query('update', BenchmarkRecordModel.query, user,
+                                       'Benchmark', BenchmarkRecordModel)
+                return len(query.with_entities(BenchmarkRecordModel.id).all())
+
+            def get_record():
+                query = ac.alter_query('update', BenchmarkRecordModel.query, user,
+                                       'Benchmark', BenchmarkRecordModel)
+                return query.filter(BenchmarkRecordModel.id == middle).first() is not None
+
+            t, rows = timed(list_records)
+            print('{:<7} list: {:8.1f} ms, {} rows'.format(strategy, 1e3 * t, rows))
+            t, found = timed(lambda: [get_record() for i in range(100)])
+            print('{:<7} get:  {:8.3f} ms per record'.format(strategy, 1e3 * t / 100))
+
+    os.remove(path)
+
+
+if __name__ == '__main__':
+    main(*[int(a) for a in sys.argv[1:]])
@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+from flask_script import Command, Option
+
+from .db import db
+from .models.user_model import WBUserModel
+from .password_hasher import calibrate_iterations
+
+
+class CalibratePasswordIterations(Command):
+    """Find the PBKDF2 iteration count for a target login latency on this host.
+
+    Example::
+
+        manager.add_command('calibrate-password', CalibratePasswordIterations())
+
+    """
+    option_list = (
+        Option('--target', '-t', dest='target', type=float, default=0.25,
+               help='time to hash a password, in seconds (default: 0.25)'),
+    )
+
+    def run(self, target):
+        iterations, elapsed = calibrate_iterations(target)
+        print('WOODBOX_PASSWORD_ITERATIONS = {}  # {:.0f} ms per password'.format(iterations, 1000 * elapsed))
+
+
+class WidenPasswordColumn(Command):
+    """Widen the hashed_password column of databases made by older versions.
+
+    Password hashes are stored with their algorithm, cost and salt,
+    which needs 128 characters instead of 64. Run this command once
+    when upgrading, before users log in::
+
+        manager.add_command('widen-password-column', WidenPasswordColumn())
+
+    """
+    def run(self):
+        statement = WBUserModel.widen_password_column_statement(db.engine.dialect.name)
+        if statement is None:
+            print('Nothing to do for {}.'.format(db.engine.dialect.name))
+            return
+        db.session.execute(statement)
+        db.session.commit()
+        WBUserModel._password_column_length = False
+        print(statement)
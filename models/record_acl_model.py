@@ -1,10 +1,134 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import threading
+import time
+
+from array import array
+from bisect import bisect_left
+from itertools import islice
+
+from sqlalchemy import and_
+from sqlalchemy.event import listen
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Session, object_session
+from sqlalchemy.sql.expression import Insert
 
 from ..db import db
 from .user_model import WBUserModel
 
+
+class RecordACLIndex(object):
+    """In-process index of the record ids granted by RecordACLModel.
+
+    For each (record_type, permission, user_role_id), the index keeps
+    the sorted array of permitted record ids. An array is loaded from
+    the database the first time it is needed, and loaded again once it
+    is older than `ttl` seconds, so that changes made by other
+    processes are seen after at most `ttl` seconds. Records inserted
+    or deleted through the ORM, or with :meth:`RecordACLModel.grant`
+    and :meth:`RecordACLModel.revoke`, are applied to loaded arrays
+    after commit.
+
+    Arrays are only kept when they are loaded by a session that has no
+    uncommitted ACL changes, so that a rolled back grant is never
+    cached.
+
+    Changes made with other Core statements or ``Query.delete()``
+    bypass the ORM events: call :meth:`invalidate` after committing
+    them.
+
+    """
+    def __init__(self, ttl=60, timer=time.time):
+        self.ttl = ttl
+        self.timer = timer
+        self._ids = dict()      # (record_type, permission, user_role_id) -> (expiry time, array of record ids)
+        self._lock = threading.Lock()
+        # Incremented on every change, so that cached query plans
+        # depending on the index can be told apart.
+        self.version = 0
+
+    def __len__(self):
+        return len(self._ids)
+
+    @staticmethod
+    def _has_uncommitted_changes(session):
+        return any(session.info.get(k) for k in ('woodbox.acl_added',
+                                                 'woodbox.acl_removed',
+                                                 'woodbox.acl_invalidated'))
+
+    def get(self, record_type, permission, user_role_id):
+        """Return the sorted array of record ids for which `user_role_id` has `permission`."""
+        key = (record_type, permission, user_role_id)
+        entry = self._ids.get(key)
+        if entry is not None and entry[0] > self.timer():
+            return entry[1]
+
+        version = self.version
+        session = db.session()
+        rows = session.query(RecordACLModel.record_id) \
+                      .filter(RecordACLModel.record_type == record_type,
+                              RecordACLModel.permission == permission,
+                              RecordACLModel.user_role_id == user_role_id) \
+                      .order_by(RecordACLModel.record_id)
+        ids = array(str('l'), (r.record_id for r in rows))
+        # The rows read by a session with uncommitted changes may be
+        # rolled back: they are used for this lookup only.
+        if self._has_uncommitted_changes(session):
+            return ids
+        with self._lock:
+            # Do not keep the array if the index changed while it was loaded.
+            if version == self.version:
+                if entry is not None and entry[1] != ids:
+                    # Plans built from the expired array must not be reused.
+                    self.version += 1
+                self._ids[key] = (self.timer() + self.ttl, ids)
+        return ids
+
+    def count(self, record_type, permission, user_role_ids):
+        """Return an upper bound of the number of records permitted to any of `user_role_ids`."""
+        return sum(len(self.get(record_type, permission, r)) for r in user_role_ids)
+
+    def permits(self, record_type, permission, user_role_ids, record_id):
+        """Return True if one of `user_role_ids` has `permission` on the record."""
+        for r in user_role_ids:
+            ids = self.get(record_type, permission, r)
+            i = bisect_left(ids, record_id)
+            if i < len(ids) and ids[i] == record_id:
+                return True
+        return False
+
+    def permitted_ids(self, record_type, permission, user_role_ids):
+        """Return the sorted list of record ids permitted to any of `user_role_ids`."""
+        ids = set()
+        for r in user_role_ids:
+            ids.update(self.get(record_type, permission, r))
+        return sorted(ids)
+
+    def apply(self, added, removed):
+        """Update the loaded arrays with lists of added and removed (key, record_id)."""
+        with self._lock:
+            self.version += 1
+            changes = dict()
+            for key, record_id in added:
+                if key in self._ids:
+                    changes.setdefault(key, (set(), set()))[0].add(record_id)
+            for key, record_id in removed:
+                if key in self._ids:
+                    changes.setdefault(key, (set(), set()))[1].add(record_id)
+            # Arrays are replaced rather than updated in place, so that
+            # readers never see a partially updated array.
+            for key, (a, r) in changes.items():
+                expires, ids = self._ids[key]
+                ids = (set(ids) | a) - r
+                self._ids[key] = (expires, array(str('l'), sorted(ids)))
+
+    def invalidate(self):
+        with self._lock:
+            self.version += 1
+            self._ids.clear()
+
+
 class RecordACLModel(db.Model):
     id = db.Column(db.Integer, db.Sequence('record_acl_model_id_seq'), primary_key=True)
     record_type = db.Column(db.String(100), nullable=False)
@@ -15,11 +139,174 @@ class RecordACLModel(db.Model):
     __table_args__ = (db.UniqueConstraint('record_type', 'record_id',
                                           'user_role_id',
                                           'permission',
-                                          name='_unique_acl'),)
+                                          name='_unique_acl'),
+                      # Covers the lookups made by InRecordACL.
+                      db.Index('ix_record_acl_lookup', 'record_type',
+                               'permission', 'user_role_id', 'record_id'))
+
+    # Used by InRecordACL(strategy='index').
+    index = RecordACLIndex()
+
+    def index_key(self):
+        return (self.record_type, self.permission, self.user_role_id), self.record_id
+
+    @classmethod
+    def grant(cls, record_types, record_ids, user_role_ids, permissions, batch_size=1000):
+        """Grant `permissions` on records to roles, for all combinations of the arguments.
+
+        `record_ids` may be any iterable, like a generator; it is only
+        iterated once. The other arguments are small collections.
+
+        For each batch of about `batch_size` rows, the existing rows
+        are selected, and the others are inserted with one executemany
+        INSERT. Rows inserted by a concurrent transaction between the
+        SELECT and the INSERT are skipped thanks to the _unique_acl
+        constraint (INSERT OR IGNORE on SQLite, ON DUPLICATE KEY UPDATE
+        on MySQL, ON CONFLICT DO NOTHING on PostgreSQL 9.5 and later);
+        other databases, and older PostgreSQL versions, raise an
+        IntegrityError. Other errors, like a foreign key violation for
+        an unknown role, are not ignored. The changes are made in the
+        current transaction; the caller must commit.
+
+        Return the number of rows inserted.
+        """
+        table = cls.__table__
+        session = db.session()
+        combinations = [(t, r, p) for t in record_types for r in user_role_ids for p in permissions]
+        if not combinations:
+            return 0
+
+        count = 0
+        added = session.info.setdefault('woodbox.acl_added', [])
+        for batch in _batches(record_ids, max(1, batch_size // len(combinations))):
+            existing = session.execute(
+                table.select().with_only_columns([table.c.record_type, table.c.record_id,
+                                                  table.c.user_role_id, table.c.permission])
+                              .where(and_(table.c.record_type.in_(record_types),
+                                          table.c.record_id.in_(batch),
+                                          table.c.user_role_id.in_(user_role_ids),
+                                          table.c.permission.in_(permissions))))
+            seen = set(tuple(row) for row in existing)
+            rows = []
+            for i in batch:
+                for t, r, p in combinations:
+                    if (t, i, r, p) not in seen:
+                        seen.add((t, i, r, p))
+                        rows.append({'record_type': t, 'record_id': i, 'user_role_id': r, 'permission': p})
+                        added.append(((t, p, r), i))
+            if rows:
+                count += session.execute(_InsertIgnore(table), rows).rowcount
+        return count
+
+    @classmethod
+    def revoke(cls, record_types, record_ids, user_role_ids, permissions, batch_size=1000):
+        """Revoke `permissions` on records from roles, for all combinations of the arguments.
+
+        `record_ids` may be any iterable, like a generator; it is only
+        iterated once. Rows are deleted with one DELETE per batch of
+        `batch_size` record ids. The changes are made in the current
+        transaction; the caller must commit.
+
+        Return the number of rows deleted.
+        """
+        table = cls.__table__
+        session = db.session()
+        count = 0
+        removed = session.info.setdefault('woodbox.acl_removed', [])
+        for batch in _batches(record_ids, batch_size):
+            result = session.execute(table.delete().where(and_(table.c.record_type.in_(record_types),
+                                                               table.c.record_id.in_(batch),
+                                                               table.c.user_role_id.in_(user_role_ids),
+                                                               table.c.permission.in_(permissions))))
+            count += result.rowcount
+            removed.extend(((t, p, r), i) for i in batch
+                           for t in record_types for r in user_role_ids for p in permissions)
+        return count
+
+    @staticmethod
+    def record_inserted(mapper, connection, target):
+        object_session(target).info.setdefault('woodbox.acl_added', []).append(target.index_key())
+
+    @staticmethod
+    def record_deleted(mapper, connection, target):
+        object_session(target).info.setdefault('woodbox.acl_removed', []).append(target.index_key())
+
+    @staticmethod
+    def record_updated(mapper, connection, target):
+        object_session(target).info['woodbox.acl_invalidated'] = True
+
+    @staticmethod
+    def update_index(session):
+        added = session.info.pop('woodbox.acl_added', [])
+        removed = session.info.pop('woodbox.acl_removed', [])
+        if session.info.pop('woodbox.acl_invalidated', False):
+            RecordACLModel.index.invalidate()
+        elif added or removed:
+            RecordACLModel.index.apply(added, removed)
+
+    @staticmethod
+    def discard_index_changes(session):
+        session.info.pop('woodbox.acl_added', None)
+        session.info.pop('woodbox.acl_removed', None)
+        session.info.pop('woodbox.acl_invalidated', None)
+
+
+listen(RecordACLModel, 'after_insert', RecordACLModel.record_inserted, propagate=True)
+listen(RecordACLModel, 'after_delete', RecordACLModel.record_deleted, propagate=True)
+listen(RecordACLModel, 'after_update', RecordACLModel.record_updated, propagate=True)
+listen(Session, 'after_commit', RecordACLModel.update_index)
+listen(Session, 'after_rollback', RecordACLModel.discard_index_changes)
+listen(RecordACLModel.__table__, 'after_create', lambda *args, **kwargs: RecordACLModel.index.invalidate())
+
+
+class _InsertIgnore(Insert):
+    """INSERT statement skipping the rows that violate a unique constraint."""
+
+
+@compiles(_InsertIgnore)
+def _compile_insert_ignore(insert, compiler, **kwargs):
+    # Other databases do not skip duplicates: concurrent grants of the
+    # same rows fail with an IntegrityError.
+    return compiler.visit_insert(insert, **kwargs)
+
+
+@compiles(_InsertIgnore, 'sqlite')
+def _compile_insert_ignore_sqlite(insert, compiler, **kwargs):
+    # OR IGNORE does not apply to foreign key violations.
+    return compiler.visit_insert(insert, **kwargs).replace('INSERT', 'INSERT OR IGNORE', 1)
+
+
+@compiles(_InsertIgnore, 'mysql')
+def _compile_insert_ignore_mysql(insert, compiler, **kwargs):
+    # Unlike INSERT IGNORE, this neither hides other errors nor warns
+    # about the duplicates.
+    return compiler.visit_insert(insert, **kwargs) + ' ON DUPLICATE KEY UPDATE id = id'
+
+
+@compiles(_InsertIgnore, 'postgresql')
+def _compile_insert_ignore_postgresql(insert, compiler, **kwargs):
+    statement = compiler.visit_insert(insert, **kwargs)
+    # ON CONFLICT was added in PostgreSQL 9.5. The version is unknown
+    # when compiling without a connection.
+    if (compiler.dialect.server_version_info or (9, 5)) >= (9, 5):
+        statement += ' ON CONFLICT DO NOTHING'
+    return statement
+
+
+def _batches(iterable, size):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, size))
+        if not batch:
+            return
+        yield batch
 
 
 def make_record_acl(record_types, record_ids, user_role_ids, permissions):
-    """Helper function to build a list of RecordACLModels."""
+    """Helper function to build a list of RecordACLModels.
+
+    To grant permissions on many records, use :meth:`RecordACLModel.grant`.
+    """
     acl = []
     for r in record_types:
         for i in record_ids:
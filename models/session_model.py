@@ -4,18 +4,107 @@ from __future__ import absolute_import, print_function, unicode_literals
 import binascii
 import hashlib
 import os
+import threading
+import time
 
+from collections import namedtuple
 from datetime import timedelta
+from hashlib import sha256
+from hmac import new as hmac_new
 
 import arrow
 
+from sqlalchemy import bindparam
+from sqlalchemy.event import listen
 from sqlalchemy.exc import ArgumentError
 
 from sqlalchemy_utils import ArrowType
 
+from twisted.logger import Logger
+
 from ..db import db
+from ..utils.cache import TTLCache
 from .user_model import WBUserModel
 
+
+log = Logger()
+
+# signer is an HMAC object keyed with the secret. Copy it to sign a
+# message instead of deriving the key state again.
+SessionCredentials = namedtuple('SessionCredentials', ['secret', 'user_id', 'accessed', 'signer'])
+
+
+class SessionAccessRecorder(object):
+    """Record session access times in memory and write them in bulk.
+
+    Pending access times are written with a single UPDATE statement
+    when `flush_interval` seconds have passed since the last write or
+    when `max_pending` sessions are pending. Writes are only triggered
+    by :meth:`record`: to write the access times of an idle process,
+    :meth:`flush` must also be called periodically, for example with a
+    :class:`woodbox.session_sweeper.AccessTimeFlusher` (started by
+    :func:`woodbox.create_server`).
+
+    If the UPDATE fails, the access times are kept for the next flush.
+    :meth:`flush` raises the error, but :meth:`record` logs it, so that
+    the request recording an access time does not fail.
+
+    To use it, set :attr:`WBSessionModel.access_recorder` to an
+    instance of this class.
+    """
+    def __init__(self, flush_interval=5, max_pending=100, timer=time.time):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self.timer = timer
+        self.pending = dict()   # session primary key -> access time
+        self.last_flush = timer()
+        self._lock = threading.Lock()
+
+    def record(self, key, accessed):
+        with self._lock:
+            self.pending[key] = accessed
+            due = (len(self.pending) >= self.max_pending or
+                   self.timer() - self.last_flush >= self.flush_interval)
+        if due:
+            try:
+                self.flush()
+            except Exception:
+                log.failure("Session access time flush failed.")
+
+    def get(self, key):
+        """Return the pending access time of the session, or None."""
+        return self.pending.get(key)
+
+    def discard(self, key):
+        with self._lock:
+            self.pending.pop(key, None)
+
+    def flush(self):
+        """Write all pending access times. Return the number of sessions written."""
+        with self._lock:
+            pending, self.pending = self.pending, dict()
+            self.last_flush = self.timer()
+        if not pending:
+            return 0
+
+        table = WBSessionModel.__table__
+        statement = table.update().where(table.c.id == bindparam('_id')).values(
+            accessed=bindparam('_accessed', type_=table.c.accessed.type))
+        try:
+            db.session.execute(statement, [{'_id': k, '_accessed': v} for k, v in pending.items()])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            # Put the access times back, unless the sessions were
+            # accessed again in the meantime, so that the next flush
+            # writes them.
+            with self._lock:
+                for key, accessed in pending.items():
+                    self.pending.setdefault(key, accessed)
+            raise
+        return len(pending)
+
+
 # Should be renamed Credentials
 class WBSessionModel(db.Model):
     session_id_byte_length = 24
@@ -23,6 +112,18 @@ class WBSessionModel(db.Model):
 
     session_max_idle_time = 60*60
 
+    # Cache of session_id -> SessionCredentials, used to authenticate
+    # requests without querying the session table.
+    credential_cache = TTLCache(maxsize=10000, ttl=60)
+
+    # Cache of session ids that do not match any session, so that
+    # clients retrying with a stale credential do not hit the database.
+    unknown_credential_cache = TTLCache(maxsize=10000, ttl=10)
+
+    # If set to a SessionAccessRecorder, touch() does not write the
+    # access time to the database right away.
+    access_recorder = None
+
     id = db.Column(db.Integer, db.Sequence('wb_session_model_id_seq'), primary_key=True)
     type = db.Column(db.String(50))
     session_id = db.Column(db.String(2*session_id_byte_length),
@@ -30,7 +131,7 @@ class WBSessionModel(db.Model):
     secret = db.Column(db.String(2*secret_byte_length), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('wb_user_model.id'), nullable=False)
     created = db.Column(ArrowType, nullable=False)
-    accessed = db.Column(ArrowType, nullable=False)
+    accessed = db.Column(ArrowType, nullable=False, index=True)
 
     __mapper_args__ = {
         'polymorphic_identity': 'wb_session_model',
@@ -47,12 +148,85 @@ class WBSessionModel(db.Model):
         else:
             raise ArgumentError('Unknown user id')
 
+    @classmethod
+    def get_credentials(cls, session_id):
+        """Return the SessionCredentials for `session_id`, or None if there is no such session.
+
+        Credentials are served from :attr:`credential_cache` when
+        possible. Unknown session ids are remembered in
+        :attr:`unknown_credential_cache`.
+        """
+        credentials = cls.credential_cache.get(session_id)
+        if credentials is None:
+            if session_id in cls.unknown_credential_cache:
+                return None
+            session = cls.query.filter_by(session_id=session_id).first()
+            if session is None:
+                cls.unknown_credential_cache.set(session_id, True)
+                return None
+            credentials = session.credentials()
+            cls.credential_cache.set(session_id, credentials)
+        return credentials
+
+    @classmethod
+    def delete_expired(cls, batch_size=1000):
+        """Delete at most `batch_size` expired sessions, oldest first.
+
+        Return the number of sessions deleted.
+        """
+        if cls.access_recorder is not None:
+            cls.access_recorder.flush()
+
+        cutoff = arrow.utcnow() - timedelta(seconds=cls.session_max_idle_time)
+        rows = db.session.query(cls.id, cls.session_id).filter(cls.accessed < cutoff) \
+                                                      .order_by(cls.accessed) \
+                                                      .limit(batch_size).all()
+        if not rows:
+            return 0
+
+        # Check the access time again, in case a session was touched
+        # since it was selected.
+        count = cls.query.filter(cls.id.in_([r.id for r in rows]), cls.accessed < cutoff) \
+                         .delete(synchronize_session=False)
+        db.session.commit()
+        for r in rows:
+            cls.credential_cache.evict(r.session_id)
+        return count
+
+    def credentials(self):
+        return SessionCredentials(self.secret, self.user_id, self.accessed,
+                                  hmac_new(self.secret.encode('utf-8'), digestmod=sha256))
+
+    def last_accessed(self):
+        """Return the last access time, including a pending one."""
+        if self.access_recorder is not None:
+            pending = self.access_recorder.get(self.id)
+            if pending is not None and pending > self.accessed:
+                return pending
+        return self.accessed
+
     def touch(self):
-        if arrow.utcnow() - self.accessed > timedelta(seconds=self.session_max_idle_time):
+        if arrow.utcnow() - self.last_accessed() > timedelta(seconds=self.session_max_idle_time):
+            if self.access_recorder is not None:
+                self.access_recorder.discard(self.id)
+            session_id = self.session_id
             db.session.delete(self)
             db.session.commit()
+            self.credential_cache.evict(session_id)
             return False
+        elif self.access_recorder is not None:
+            accessed = arrow.utcnow()
+            self.access_recorder.record(self.id, accessed)
+            self.credential_cache.set(self.session_id, self.credentials()._replace(accessed=accessed))
+            return True
         else:
             self.accessed = arrow.utcnow()
             db.session.commit()
+            self.credential_cache.set(self.session_id, self.credentials())
             return True
+
+    @staticmethod
+    def forget_unknown_credential(mapper, connection, target):
+        WBSessionModel.unknown_credential_cache.evict(target.session_id)
+
+listen(WBSessionModel, 'after_insert', WBSessionModel.forget_unknown_credential, propagate=True)
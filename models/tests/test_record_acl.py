@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+from sqlalchemy import event
+from sqlalchemy.dialects import mysql, postgresql, sqlite
 from sqlalchemy.exc import IntegrityError
 
 from woodbox.db import db
-from woodbox.models.record_acl_model import RecordACLModel
+from woodbox.models.record_acl_model import RecordACLIndex, RecordACLModel, _InsertIgnore
 from woodbox.models.user_model import WBUserModel, WBRoleModel
 from woodbox.tests.flask_test_case import FlaskTestCase
 
@@ -70,3 +72,110 @@ class TestUser(FlaskTestCase):
             db.session.add_all([ace1, ace2])
             self.assertRaises(IntegrityError, db.session.commit)
             db.session.rollback()
+
+    def test_grant_revoke(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+
+            role1 = WBRoleModel(rolename='a')
+            role2 = WBRoleModel(rolename='b')
+            db.session.add_all([role1, role2])
+            db.session.commit()
+            roles = [role1.id, role2.id]
+
+            db.session.add(RecordACLModel(record_type='T', record_id=3,
+                                          user_role_id=role1.id, permission='read'))
+            db.session.commit()
+            self.assertFalse(RecordACLModel.index.permits('T', 'read', [role2.id], 5))
+
+            count = RecordACLModel.grant(['T'], (i for i in range(10)), roles, ['read', 'update'],
+                                         batch_size=7)
+            db.session.commit()
+            self.assertEqual(count, 39)
+            self.assertEqual(RecordACLModel.query.count(), 40)
+            self.assertTrue(RecordACLModel.index.permits('T', 'read', [role2.id], 5))
+
+            # Granting again is a no-op.
+            self.assertEqual(RecordACLModel.grant(['T'], [1, 1, 2], roles, ['read']), 0)
+
+            count = RecordACLModel.revoke(['T'], (i for i in range(5, 20)), [role2.id], ['read'],
+                                          batch_size=4)
+            db.session.commit()
+            self.assertEqual(count, 5)
+            self.assertEqual(RecordACLModel.query.count(), 35)
+            self.assertFalse(RecordACLModel.index.permits('T', 'read', [role2.id], 5))
+            self.assertTrue(RecordACLModel.index.permits('T', 'read', [role2.id], 4))
+
+    def test_grant_ignores_duplicates(self):
+        statement = _InsertIgnore(RecordACLModel.__table__)
+        self.assertTrue(str(statement.compile(dialect=sqlite.dialect())).startswith('INSERT OR IGNORE INTO'))
+        self.assertTrue(str(statement.compile(dialect=mysql.dialect())).endswith(
+            ' ON DUPLICATE KEY UPDATE id = id'))
+        self.assertTrue(str(statement.compile(dialect=postgresql.dialect())).endswith(' ON CONFLICT DO NOTHING'))
+        dialect = postgresql.dialect()
+        dialect.server_version_info = (9, 4)
+        self.assertNotIn('ON CONFLICT', str(statement.compile(dialect=dialect)))
+
+        with self.app.test_request_context('/'):
+            db.initialize()
+            role = WBRoleModel(rolename='a')
+            db.session.add(role)
+            db.session.commit()
+
+            # A row inserted by a concurrent transaction after the
+            # existing rows were selected is skipped instead of failing.
+            table = RecordACLModel.__table__
+
+            def insert_concurrently(conn, cursor, statement, parameters, context, executemany):
+                if statement.startswith('INSERT') and not inserted:
+                    inserted.append(True)
+                    conn.execute(table.insert(), [{'record_type': 'T', 'record_id': 2,
+                                                   'user_role_id': role.id, 'permission': 'read'}])
+
+            inserted = []
+            event.listen(db.engine, 'before_cursor_execute', insert_concurrently)
+            try:
+                count = RecordACLModel.grant(['T'], [1, 2, 3], [role.id], ['read'])
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', insert_concurrently)
+            db.session.commit()
+            self.assertEqual(RecordACLModel.query.count(), 3)
+            self.assertEqual(count, 2)
+
+            # Foreign key violations are not ignored (SQLite does not
+            # enforce foreign keys by default).
+            if db.engine.dialect.name != 'sqlite':
+                with self.assertRaises(IntegrityError):
+                    RecordACLModel.grant(['T'], [4], [role.id + 1000], ['read'])
+                db.session.rollback()
+
+    def test_index_expiry(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            role = WBRoleModel(rolename='a')
+            db.session.add(role)
+            db.session.commit()
+
+            now = [0]
+            index = RecordACLIndex(ttl=10, timer=lambda: now[0])
+
+            # A grant that is not committed is seen, but not cached.
+            db.session.add(RecordACLModel(record_type='T', record_id=1,
+                                          user_role_id=role.id, permission='read'))
+            db.session.flush()
+            self.assertEqual(list(index.get('T', 'read', role.id)), [1])
+            self.assertEqual(len(index), 0)
+            db.session.rollback()
+            self.assertEqual(list(index.get('T', 'read', role.id)), [])
+            self.assertEqual(len(index), 1)
+
+            # Changes bypassing the ORM events are seen once the array expires.
+            db.session.execute(RecordACLModel.__table__.insert(),
+                               [{'record_type': 'T', 'record_id': 2,
+                                 'user_role_id': role.id, 'permission': 'read'}])
+            db.session.commit()
+            self.assertEqual(list(index.get('T', 'read', role.id)), [])
+            version = index.version
+            now[0] = 11
+            self.assertEqual(list(index.get('T', 'read', role.id)), [2])
+            self.assertGreater(index.version, version)
@@ -9,7 +9,7 @@ import arrow
 from sqlalchemy.exc import ArgumentError, IntegrityError
 
 from woodbox.db import db
-from woodbox.models.session_model import WBSessionModel
+from woodbox.models.session_model import SessionAccessRecorder, WBSessionModel
 from woodbox.models.user_model import WBUserModel
 from woodbox.tests.flask_test_case import FlaskTestCase
 
@@ -71,3 +71,135 @@ class TestSession(FlaskTestCase):
             self.assertFalse(session.touch())
             read_session = WBSessionModel.query.get(session.id)
             self.assertFalse(read_session)
+
+    def test_credential_cache(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            db.session.add(user)
+            db.session.commit()
+
+            session = WBSessionModel(user.id)
+            db.session.add(session)
+            db.session.commit()
+
+            self.assertIsNone(WBSessionModel.get_credentials('garbage'))
+
+            credentials = WBSessionModel.get_credentials(session.session_id)
+            self.assertEqual(credentials.secret, session.secret)
+            self.assertEqual(credentials.user_id, user.id)
+            self.assertIn(session.session_id, WBSessionModel.credential_cache)
+
+            # Expire the session.
+            session.accessed = arrow.utcnow() - timedelta(seconds=WBSessionModel.session_max_idle_time + 1)
+            self.assertFalse(session.touch())
+            self.assertNotIn(session.session_id, WBSessionModel.credential_cache)
+            self.assertIsNone(WBSessionModel.get_credentials(session.session_id))
+
+    def test_unknown_credential_cache(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            db.session.add(user)
+            db.session.commit()
+
+            session_id = self.str_n(2*WBSessionModel.session_id_byte_length)
+            self.assertIsNone(WBSessionModel.get_credentials(session_id))
+            self.assertIn(session_id, WBSessionModel.unknown_credential_cache)
+
+            hits = WBSessionModel.unknown_credential_cache.hits
+            self.assertIsNone(WBSessionModel.get_credentials(session_id))
+            self.assertEqual(WBSessionModel.unknown_credential_cache.hits, hits + 1)
+
+            # Creating a session with this id clears the negative cache entry.
+            session = WBSessionModel(user.id)
+            session.session_id = session_id
+            db.session.add(session)
+            db.session.commit()
+            self.assertNotIn(session_id, WBSessionModel.unknown_credential_cache)
+            self.assertEqual(WBSessionModel.get_credentials(session_id).secret, session.secret)
+
+    def test_write_behind(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            db.session.add(user)
+            db.session.commit()
+
+            s1 = WBSessionModel(user.id)
+            s2 = WBSessionModel(user.id)
+            db.session.add_all([s1, s2])
+            db.session.commit()
+            created = s1.created
+
+            WBSessionModel.access_recorder = SessionAccessRecorder(flush_interval=3600, max_pending=2)
+            try:
+                # Make the stored access time look expired: the pending
+                # access time must be used instead.
+                self.assertTrue(s1.touch())
+                old = arrow.utcnow() - timedelta(seconds=WBSessionModel.session_max_idle_time + 1)
+                WBSessionModel.query.filter_by(id=s1.id).update({'accessed': old})
+                db.session.commit()
+                db.session.expire_all()
+                self.assertTrue(s1.touch())
+                self.assertEqual(WBSessionModel.query.get(s1.id).accessed, old)
+
+                # Second pending session: both are written.
+                self.assertTrue(s2.touch())
+                self.assertEqual(WBSessionModel.access_recorder.pending, {})
+                db.session.expire_all()
+                self.assertGreater(WBSessionModel.query.get(s1.id).accessed, old)
+                self.assertGreaterEqual(WBSessionModel.query.get(s2.id).accessed, created)
+            finally:
+                WBSessionModel.access_recorder = None
+
+    def test_access_recorder_failed_flush(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            recorder = SessionAccessRecorder(flush_interval=3600, max_pending=100)
+            # The UPDATE fails to convert the access time.
+            recorder.record(1, 'not a date')
+            self.assertRaises(Exception, recorder.flush)
+            self.assertEqual(recorder.pending, {1: 'not a date'})
+
+    def test_access_recorder_failed_flush_in_touch(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            db.session.add(user)
+            db.session.commit()
+            session = WBSessionModel(user.id)
+            db.session.add(session)
+            db.session.commit()
+
+            recorder = SessionAccessRecorder(flush_interval=3600, max_pending=2)
+            recorder.record(-1, 'not a date')
+            WBSessionModel.access_recorder = recorder
+            try:
+                # The write triggered by touch() fails: the session is
+                # still valid and the access times are kept.
+                self.assertTrue(session.touch())
+                self.assertEqual(sorted(recorder.pending.keys()), [-1, session.id])
+            finally:
+                WBSessionModel.access_recorder = None
+
+    def test_delete_expired(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            db.session.add(user)
+            db.session.commit()
+
+            sessions = [WBSessionModel(user.id) for i in range(5)]
+            old = arrow.utcnow() - timedelta(seconds=WBSessionModel.session_max_idle_time + 1)
+            for s in sessions[:3]:
+                s.accessed = old
+            db.session.add_all(sessions)
+            db.session.commit()
+            active = sessions[3].id
+
+            self.assertEqual(WBSessionModel.delete_expired(batch_size=2), 2)
+            self.assertEqual(WBSessionModel.delete_expired(batch_size=2), 1)
+            self.assertEqual(WBSessionModel.delete_expired(batch_size=2), 0)
+            self.assertEqual(WBSessionModel.query.count(), 2)
+            self.assertIsNotNone(WBSessionModel.query.get(active))
@@ -61,7 +61,10 @@ class TestUser(FlaskTestCase):
             self.assertEqual(len(password), 1024)
 
             hashed_password = WBUserModel.hash_password(password)
-            self.assertEqual(len(hashed_password), 64)
+            algorithm, iterations, salt, bin_hash = hashed_password.split('$')
+            self.assertEqual(algorithm, 'pbkdf2_sha256')
+            self.assertEqual(int(iterations), WBUserModel.default_password_iterations)
+            self.assertEqual(len(bin_hash), 64)
 
             db.initialize()
             user = WBUserModel(username='alice', password=password)
@@ -69,7 +72,29 @@ class TestUser(FlaskTestCase):
             db.session.commit()
             read_user = WBUserModel.query.get(user.id)
             self.assertEqual(read_user.id, user.id)
-            self.assertEqual(read_user.hashed_password, hashed_password)
+            self.assertNotEqual(read_user.hashed_password, hashed_password)
+            self.assertTrue(read_user.check_password(password))
+            self.assertFalse(read_user.check_password(password + 'a'))
+            self.assertFalse(read_user.needs_rehash())
+
+    def test_legacy_hashed_password(self):
+        """Test that hashes made with the application salt are accepted."""
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='alice', password='abc')
+            user.hashed_password = WBUserModel.hash_password_legacy('abc')
+            self.assertEqual(len(user.hashed_password), 64)
+            self.assertTrue(user.check_password('abc'))
+            self.assertFalse(user.check_password('abd'))
+            self.assertTrue(user.needs_rehash())
+
+            self.app.config['WOODBOX_PASSWORD_ITERATIONS'] = 1000
+            user.set_password('abc')
+            self.assertTrue(user.hashed_password.startswith('pbkdf2_sha256$1000$'))
+            self.assertTrue(user.check_password('abc'))
+            self.assertFalse(user.needs_rehash())
+            self.app.config['WOODBOX_PASSWORD_ITERATIONS'] = 2000
+            self.assertTrue(user.needs_rehash())
 
 
     def test_anonymous_role(self):
@@ -113,3 +138,46 @@ class TestUser(FlaskTestCase):
             db.session.commit()
             read_user = WBUserModel.query.get(user.id)
             self.assertIn(role, read_user.roles)
+
+    def test_get_roles(self):
+        """Test the role cache and its invalidation."""
+        with self.app.test_request_context('/'):
+            db.initialize()
+
+            a = WBRoleModel(rolename='a')
+            b = WBRoleModel(rolename='b')
+            user = WBUserModel(username='alice', password='abc', roles=[a])
+            db.session.add_all([a, b, user])
+            db.session.commit()
+
+            roles = WBUserModel.get_roles(user.id)
+            self.assertEqual(roles.names, {'a'})
+            self.assertEqual(roles.ids, {a.id})
+            self.assertIs(WBUserModel.get_roles(user.id), roles)
+            self.assertEqual(WBUserModel.get_roles(None).names, {WBRoleModel.anonymous_role_name})
+
+            user.roles.append(b)
+            db.session.commit()
+            self.assertEqual(WBUserModel.get_roles(user.id).names, {'a', 'b'})
+
+            b.rolename = 'c'
+            db.session.commit()
+            self.assertEqual(WBUserModel.get_roles(user.id).names, {'a', 'c'})
+
+            user.roles.remove(a)
+            db.session.commit()
+            self.assertEqual(WBUserModel.get_roles(user.id).names, {'c'})
+
+        with self.app.test_request_context('/'):
+            # Served from the cross-request cache.
+            self.assertEqual(WBUserModel.get_roles(user.id).names, {'c'})
+
+    def test_widen_password_column(self):
+        with self.app.test_request_context('/'):
+            db.initialize()
+            self.assertEqual(WBUserModel.password_column_length(), 128)
+        self.assertIsNone(WBUserModel.widen_password_column_statement('sqlite'))
+        self.assertEqual(WBUserModel.widen_password_column_statement('postgresql'),
+                         'ALTER TABLE wb_user_model ALTER COLUMN hashed_password TYPE VARCHAR(128)')
+        self.assertEqual(WBUserModel.widen_password_column_statement('mysql'),
+                         'ALTER TABLE wb_user_model MODIFY hashed_password VARCHAR(128) NOT NULL')
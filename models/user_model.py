@@ -2,11 +2,24 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import binascii
+import os
 
-from flask import current_app
+from collections import namedtuple
+
+from flask import current_app, g, has_app_context
+
+from sqlalchemy import inspect
+from sqlalchemy.event import listen
+from sqlalchemy.orm import Session, object_session
 
 from ..db import db, DatabaseInitializer
-from ..utils.pbkdf2_hmac import pbkdf2_hmac
+from ..password_hasher import password_hasher
+from ..utils.cache import TTLCache
+from ..utils.compare_digest import compare_digest
+
+
+# Role ids and role names of a user, as frozensets.
+UserRoles = namedtuple('UserRoles', ['ids', 'names'])
 
 
 user_roles = db.Table('wb_user_roles_association',
@@ -55,11 +68,41 @@ class WBRoleModelInitializer(DatabaseInitializer):
 
 
 class WBUserModel(db.Model):
-    """A user of the API."""
+    """A user of the API.
+
+    Passwords are stored as ``pbkdf2_sha256$<iterations>$<salt>$<hash>``.
+    The number of iterations is read from the
+    ``WOODBOX_PASSWORD_ITERATIONS`` configuration value. Hashes made
+    with a different number of iterations, or with the application
+    wide ``PASSWORD_SALT`` of older versions, are still accepted; use
+    :meth:`needs_rehash` to find out if a hash should be upgraded.
+
+    Legacy hashes are verified by hashing the password with
+    ``PASSWORD_SALT`` and 200000 iterations, as older versions did.
+    After a successful login, :meth:`upgrade_password` replaces them
+    with a hash in the current format.
+
+    Upgrading from a version storing legacy hashes: the
+    ``hashed_password`` column was 64 characters long and must be
+    widened to 128 characters, for example with the
+    :class:`woodbox.commands.WidenPasswordColumn` command. Until it
+    is, hashes are not upgraded at login.
+    """
+    password_algorithm = 'pbkdf2_sha256'
+    password_salt_byte_length = 16
+    default_password_iterations = 200000
+
+    # Length of the hashed_password column, read from the database
+    # by :meth:`password_column_length`.
+    _password_column_length = False
+
+    # Cache of user id -> UserRoles, used by :meth:`get_roles`.
+    role_cache = TTLCache(maxsize=10000, ttl=60)
+
     id = db.Column(db.Integer, db.Sequence('wb_user_model_id_seq'), primary_key=True)
     type = db.Column(db.String(50))
     username = db.Column(db.String(50), nullable=False, unique=True, index=True)
-    hashed_password = db.Column(db.String(64), nullable=False)
+    hashed_password = db.Column(db.String(128), nullable=False)
 
     roles = db.relationship('WBRoleModel', secondary=user_roles)
 
@@ -72,8 +115,174 @@ class WBUserModel(db.Model):
         hashed_password = WBUserModel.hash_password(password)
         super(WBUserModel, self).__init__(hashed_password=hashed_password, **kwargs)
 
+    @classmethod
+    def password_iterations(cls):
+        return current_app.config.get('WOODBOX_PASSWORD_ITERATIONS', cls.default_password_iterations)
+
+    @classmethod
+    def hash_password(cls, password, salt=None, iterations=None):
+        """Return the hash of `password`, in the format stored in the database.
+
+        A random salt is used if `salt` is None.
+        """
+        if salt is None:
+            salt = binascii.hexlify(os.urandom(cls.password_salt_byte_length)).decode('ascii')
+        if iterations is None:
+            iterations = cls.password_iterations()
+        bin_hash = password_hasher.pbkdf2_hmac(str('sha256'), password.encode('utf-8'),
+                                               salt.encode('utf-8'), iterations)
+        return '$'.join([cls.password_algorithm, str(iterations), salt,
+                         binascii.hexlify(bin_hash).decode('ascii')])
+
     @staticmethod
-    def hash_password(password):
+    def hash_password_legacy(password):
+        """Return the hash of `password` as computed by older versions."""
         salt = current_app.config['PASSWORD_SALT']
-        bin_hash = pbkdf2_hmac(str('sha256'), password, salt, 200000)
+        bin_hash = password_hasher.pbkdf2_hmac(str('sha256'), password, salt, 200000)
         return binascii.hexlify(bin_hash)
+
+    def _parse_hashed_password(self):
+        """Return the (iterations, salt) pair of the stored hash, or None for a legacy hash."""
+        parts = self.hashed_password.split('$')
+        if len(parts) == 4 and parts[0] == self.password_algorithm:
+            return int(parts[1]), parts[2]
+        return None
+
+    def check_password(self, password):
+        """Return True if `password` matches the stored hash."""
+        params = self._parse_hashed_password()
+        if params is None:
+            hashed_password = self.hash_password_legacy(password)
+        else:
+            iterations, salt = params
+            hashed_password = self.hash_password(password, salt=salt, iterations=iterations)
+        return compare_digest(hashed_password.encode('utf-8'), self.hashed_password.encode('utf-8'))
+
+    def needs_rehash(self):
+        """Return True if the stored hash does not use the current format and cost."""
+        params = self._parse_hashed_password()
+        return params is None or params[0] != self.password_iterations()
+
+    def set_password(self, password):
+        self.hashed_password = self.hash_password(password)
+
+    @classmethod
+    def password_column_length(cls):
+        """Return the length of the hashed_password column in the database, or None if unlimited."""
+        if cls._password_column_length is False:
+            columns = inspect(db.engine).get_columns(cls.__table__.name)
+            column = [c for c in columns if c['name'] == 'hashed_password'][0]
+            cls._password_column_length = getattr(column['type'], 'length', None)
+        return cls._password_column_length
+
+    @classmethod
+    def widen_password_column_statement(cls, dialect_name):
+        """Return the statement widening the hashed_password column of older databases, or None."""
+        length = cls.__table__.c.hashed_password.type.length
+        if dialect_name == 'postgresql':
+            return 'ALTER TABLE {0} ALTER COLUMN hashed_password TYPE VARCHAR({1})'.format(cls.__table__.name, length)
+        elif dialect_name == 'mysql':
+            return 'ALTER TABLE {0} MODIFY hashed_password VARCHAR({1}) NOT NULL'.format(cls.__table__.name, length)
+        else:
+            # SQLite does not enforce the length of strings.
+            return None
+
+    def upgrade_password(self, password):
+        """Replace the stored hash by a hash in the current format, if needed.
+
+        `password` must have been checked. The hash is not replaced if
+        it does not fit in the database column, which would truncate it
+        or refuse it. Return True if the hash was replaced.
+        """
+        if not self.needs_rehash():
+            return False
+        hashed_password = self.hash_password(password)
+        length = self.password_column_length()
+        if length is not None and len(hashed_password) > length:
+            return False
+        self.hashed_password = hashed_password
+        return True
+
+    @classmethod
+    def get_roles(cls, user_id):
+        """Return the UserRoles of `user_id`, or of the anonymous user if `user_id` is None.
+
+        Roles are memoized for the current request and cached across
+        requests in :attr:`role_cache`. The cache is invalidated when
+        the roles of a user or a role are changed through the ORM.
+        """
+        memo = g.get('_woodbox_user_roles')
+        if memo is None:
+            memo = g._woodbox_user_roles = dict()
+        roles = memo.get(user_id)
+        if roles is None:
+            roles = cls.role_cache.get(user_id)
+            if roles is None:
+                if user_id is None:
+                    roles = UserRoles(frozenset([WBRoleModel.get_anonymous_role_id()]),
+                                      frozenset([WBRoleModel.anonymous_role_name]))
+                else:
+                    rows = db.session.query(WBRoleModel.id, WBRoleModel.rolename) \
+                                     .join(user_roles, user_roles.c.role_id == WBRoleModel.id) \
+                                     .filter(user_roles.c.user_id == user_id).all()
+                    roles = UserRoles(frozenset(r.id for r in rows), frozenset(r.rolename for r in rows))
+                cls.role_cache.set(user_id, roles)
+            memo[user_id] = roles
+        return roles
+
+    @classmethod
+    def forget_roles(cls, user_id=None):
+        """Drop the cached roles of `user_id`, or of all users if `user_id` is None."""
+        if user_id is None:
+            cls.role_cache.clear()
+        else:
+            cls.role_cache.evict(user_id)
+        if has_app_context():
+            g._woodbox_user_roles = dict()
+
+    # Role changes are recorded in the session and the cache is
+    # invalidated again after commit, in case another thread cached
+    # the roles read before the commit.
+
+    @staticmethod
+    def role_changed(target, *args):
+        if target.id is not None:
+            WBUserModel.forget_roles(target.id)
+        session = object_session(target)
+        if session is not None:
+            session.info.setdefault('woodbox.role_changes', set()).add(target)
+
+    @staticmethod
+    def user_inserted_or_deleted(mapper, connection, target):
+        WBUserModel.forget_roles(target.id)
+
+    @staticmethod
+    def role_model_changed(mapper, connection, target):
+        WBUserModel.forget_roles()
+        object_session(target).info['woodbox.role_model_changed'] = True
+
+    @staticmethod
+    def forget_changed_roles(session):
+        changes = session.info.pop('woodbox.role_changes', ())
+        if session.info.pop('woodbox.role_model_changed', False):
+            WBUserModel.forget_roles()
+        else:
+            for user in changes:
+                # Objects are expired after commit: read the id without loading them.
+                identity = inspect(user).identity
+                if identity is not None:
+                    WBUserModel.forget_roles(identity[0])
+
+    @staticmethod
+    def discard_role_changes(session):
+        session.info.pop('woodbox.role_changes', None)
+        session.info.pop('woodbox.role_model_changed', None)
+
+listen(WBUserModel.roles, 'append', WBUserModel.role_changed)
+listen(WBUserModel.roles, 'remove', WBUserModel.role_changed)
+listen(WBUserModel, 'after_insert', WBUserModel.user_inserted_or_deleted, propagate=True)
+listen(WBUserModel, 'after_delete', WBUserModel.user_inserted_or_deleted, propagate=True)
+listen(WBRoleModel, 'after_update', WBUserModel.role_model_changed, propagate=True)
+listen(WBRoleModel, 'after_delete', WBUserModel.role_model_changed, propagate=True)
+listen(Session, 'after_commit', WBUserModel.forget_changed_roles)
+listen(Session, 'after_rollback', WBUserModel.discard_role_changes)
@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import heapq
+import sqlite3
+import threading
+import time
+
+from abc import ABCMeta, abstractmethod
+
+
+class NonceStore(object):
+    """Base class for replay protection stores.
+
+    A nonce store remembers the keys of the requests it has seen
+    (typically the credential and the signature of the request) for
+    `window` seconds after the request timestamp. Keys are grouped in
+    buckets of `bucket_width` seconds so that old keys can be dropped a
+    whole bucket at a time.
+
+    This is an abstract class. Use :class:`MemoryNonceStore` or
+    :class:`SQLiteNonceStore`, or derivate your own class.
+
+    """
+    __metaclass__ = ABCMeta
+
+    def __init__(self, window=5*60, bucket_width=10, timer=time.time):
+        self.window = window
+        self.bucket_width = bucket_width
+        self.timer = timer
+
+    def _bucket(self, timestamp):
+        return int(timestamp // self.bucket_width)
+
+    def _cutoff(self):
+        """Return the first bucket that must be kept."""
+        return self._bucket(self.timer() - self.window)
+
+    @abstractmethod
+    def add(self, key, timestamp):
+        """Remember `key` for a request made at `timestamp` (seconds since the epoch).
+
+        Return False if `key` was already seen, True otherwise.
+        """
+        pass
+
+
+class _Shard(object):
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.keys = dict()      # key -> bucket
+        self.buckets = dict()   # bucket -> list of keys
+        self.heap = []          # buckets, oldest first
+
+
+class MemoryNonceStore(NonceStore):
+    """A nonce store keeping its keys in the process memory.
+
+    Keys are spread over `shards` independently locked shards. Insertion
+    and lookup are O(1); expired buckets are dropped without scanning
+    the keys they do not contain.
+
+    This store is only suitable for single process deployments.
+
+    """
+    def __init__(self, shards=16, *args, **kwargs):
+        super(MemoryNonceStore, self).__init__(*args, **kwargs)
+        self.shards = [_Shard() for _ in range(shards)]
+
+    def __len__(self):
+        return sum(len(s.keys) for s in self.shards)
+
+    @staticmethod
+    def _expire(shard, cutoff):
+        while shard.heap and shard.heap[0] < cutoff:
+            bucket = heapq.heappop(shard.heap)
+            for key in shard.buckets.pop(bucket):
+                del shard.keys[key]
+
+    def expire(self):
+        """Drop expired buckets from all shards.
+
+        Buckets are otherwise only dropped from a shard when a key is
+        added to it.
+        """
+        cutoff = self._cutoff()
+        for shard in self.shards:
+            with shard.lock:
+                self._expire(shard, cutoff)
+
+    def add(self, key, timestamp):
+        shard = self.shards[hash(key) % len(self.shards)]
+        bucket = self._bucket(timestamp)
+        cutoff = self._cutoff()
+        with shard.lock:
+            self._expire(shard, cutoff)
+            if key in shard.keys:
+                return False
+            shard.keys[key] = bucket
+            if bucket not in shard.buckets:
+                shard.buckets[bucket] = []
+                heapq.heappush(shard.heap, bucket)
+            shard.buckets[bucket].append(key)
+            return True
+
+
+class SQLiteNonceStore(NonceStore):
+    """A nonce store keeping its keys in a SQLite database.
+
+    Use it to share replay protection between the worker processes of
+    a host. Expired buckets are deleted with a single indexed DELETE,
+    at most once per bucket.
+
+    Arguments:
+    path -- path of the SQLite database file
+
+    """
+    def __init__(self, path, *args, **kwargs):
+        super(SQLiteNonceStore, self).__init__(*args, **kwargs)
+        self.path = path
+        self._local = threading.local()
+        self._last_cutoff = None
+        conn = self._connection()
+        conn.execute('CREATE TABLE IF NOT EXISTS wb_nonce (key TEXT PRIMARY KEY, bucket INTEGER NOT NULL)')
+        conn.execute('CREATE INDEX IF NOT EXISTS ix_wb_nonce_bucket ON wb_nonce (bucket)')
+        conn.commit()
+
+    def _connection(self):
+        # sqlite3 connections cannot be shared between threads.
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=5)
+            self._local.conn = conn
+        return conn
+
+    def add(self, key, timestamp):
+        conn = self._connection()
+        cutoff = self._cutoff()
+        with conn:
+            if cutoff != self._last_cutoff:
+                conn.execute('DELETE FROM wb_nonce WHERE bucket < ?', (cutoff,))
+                self._last_cutoff = cutoff
+            try:
+                conn.execute('INSERT INTO wb_nonce (key, bucket) VALUES (?, ?)',
+                             (key, self._bucket(timestamp)))
+            except sqlite3.IntegrityError:
+                return False
+        return True
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import multiprocessing
+import threading
+import time
+
+from .utils.pbkdf2_hmac import pbkdf2_hmac
+
+
+class PasswordHasherBusy(Exception):
+    """Raised when too many passwords are waiting to be hashed."""
+    pass
+
+
+class PasswordHasher(object):
+    """Compute password hashes in a pool of worker processes.
+
+    Password hashing is slow on purpose. Running it in a process pool
+    keeps a burst of logins from taking every thread of the WSGI thread
+    pool. At most `max_pending` hashes may be queued or running; when
+    the limit is reached, :meth:`pbkdf2_hmac` raises
+    :class:`PasswordHasherBusy` right away.
+
+    If `processes` is 0, hashes are computed in the calling thread and
+    the number of pending hashes is not limited.
+
+    The configuration values ``WOODBOX_PASSWORD_POOL_SIZE`` and
+    ``WOODBOX_PASSWORD_QUEUE_SIZE`` are read by :meth:`init_app`.
+
+    Queue depth and hash latency are available through :meth:`stats`.
+
+    """
+    def __init__(self, processes=0, max_pending=None):
+        self._lock = threading.Lock()
+        self._pool = None
+        self.configure(processes, max_pending)
+
+        self.pending = 0
+        self.hashed = 0
+        self.rejected = 0
+        self.last_latency = 0.0
+        self.max_latency = 0.0
+        self.total_latency = 0.0
+
+    def init_app(self, app):
+        self.configure(app.config.get('WOODBOX_PASSWORD_POOL_SIZE', 0),
+                       app.config.get('WOODBOX_PASSWORD_QUEUE_SIZE'))
+
+    def configure(self, processes, max_pending=None):
+        self.close()
+        self.processes = processes
+        self.max_pending = max_pending if max_pending is not None else 2 * processes
+        self._slots = threading.BoundedSemaphore(self.max_pending) if processes else None
+
+    def close(self):
+        """Terminate the worker processes. The pool is created again on next use."""
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+    def _get_pool(self):
+        # The pool is created on first use, so that the workers are not
+        # forked before the application is configured.
+        with self._lock:
+            if self._pool is None:
+                self._pool = multiprocessing.Pool(self.processes)
+            return self._pool
+
+    def pbkdf2_hmac(self, hash_name, password, salt, iterations, dklen=None):
+        """Return ``pbkdf2_hmac(hash_name, password, salt, iterations, dklen)``."""
+        if self._slots is None:
+            return self._timed(pbkdf2_hmac, hash_name, password, salt, iterations, dklen)
+
+        if not self._slots.acquire(False):
+            with self._lock:
+                self.rejected += 1
+            raise PasswordHasherBusy()
+        try:
+            pool = self._get_pool()
+            return self._timed(lambda *args: pool.apply(pbkdf2_hmac, args),
+                               hash_name, password, salt, iterations, dklen)
+        finally:
+            self._slots.release()
+
+    def _timed(self, f, *args):
+        with self._lock:
+            self.pending += 1
+        start = time.time()
+        try:
+            return f(*args)
+        finally:
+            latency = time.time() - start
+            with self._lock:
+                self.pending -= 1
+                self.hashed += 1
+                self.last_latency = latency
+                self.max_latency = max(self.max_latency, latency)
+                self.total_latency += latency
+
+    def stats(self):
+        """Return a dict with the queue depth and hash latency counters."""
+        return {'processes': self.processes,
+                'pending': self.pending,
+                'max_pending': self.max_pending,
+                'hashed': self.hashed,
+                'rejected': self.rejected,
+                'last_latency': self.last_latency,
+                'max_latency': self.max_latency,
+                'mean_latency': self.total_latency / self.hashed if self.hashed else 0.0}
+
+
+password_hasher = PasswordHasher()
+
+
+def _time_pbkdf2_hmac(hash_name, iterations, repeat=3):
+    best = None
+    for i in range(repeat):
+        start = time.time()
+        pbkdf2_hmac(hash_name, b'password', b'0123456789abcdef0123456789abcdef', iterations)
+        elapsed = time.time() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def calibrate_iterations(target, hash_name=str('sha256'), min_time=0.05):
+    """Return the number of PBKDF2 iterations taking about `target` seconds on this host.
+
+    Return an (iterations, seconds) pair, where seconds is the time
+    measured for that number of iterations.
+    """
+    iterations = 1000
+    elapsed = _time_pbkdf2_hmac(hash_name, iterations)
+    # Measure over a long enough run for the timer resolution not to matter.
+    while elapsed < min_time:
+        iterations *= 2
+        elapsed = _time_pbkdf2_hmac(hash_name, iterations)
+
+    iterations = max(1000, int(round(iterations * target / elapsed, -3)))
+    return iterations, _time_pbkdf2_hmac(hash_name, iterations)
@@ -1,19 +1,236 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import base64
+import binascii
 import importlib
+import json
 import re
 
-from flask import request, url_for, g
+from collections import defaultdict
+from weakref import WeakKeyDictionary
+
+from flask import Response, current_app, request, stream_with_context, url_for, g
 from flask_restful import Resource, abort
 from marshmallow.exceptions import ValidationError
+from marshmallow_jsonapi.fields import BaseRelationship
+from sqlalchemy import Integer, String, and_, bindparam, inspect, or_
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext import baked
+from sqlalchemy.orm import ColumnProperty, RelationshipProperty, aliased, load_only
+from sqlalchemy.orm.attributes import set_committed_value
+from werkzeug.urls import url_encode
 
 from twisted.logger import Logger
 log = Logger()
 
+from .access_control.api import Acl
 from .authenticator import HMACAuthenticator
 from .db import db
+from .jsonapi_schema import underscores_to_dashes
+from .models.user_model import WBUserModel
+
+# Cache of the queries used to load a single record, with their compiled SQL.
+bakery = baked.bakery(size=1000)
+
+# flask_restful Api -> { JSON API type: RecordAPI subclass }, filled by make_api.
+registry = WeakKeyDictionary()
+
+# Maximum number of ids in an IN clause (SQLite accepts 999 parameters).
+max_in_size = 500
+
+
+def _sparse_fields(schema_class):
+    """Return the sorted tuple of schema fields requested by the ``fields[type]`` parameter.
+
+    Return None if the parameter is not given. The id field is always
+    included.
+    """
+    value = request.args.get('fields[' + schema_class.Meta.type_ + ']')
+    if value is None:
+        return None
+    names = dict()
+    for key in schema_class._declared_fields:
+        names[key] = key
+        names[underscores_to_dashes(key)] = key
+    fields = set(['id'])
+    for name in value.split(','):
+        name = name.strip()
+        if not name:
+            continue
+        if name not in names:
+            abort(400, errors=["Unknown field '{0}' in fields[{1}].".format(name, schema_class.Meta.type_)])
+        fields.add(names[name])
+    return tuple(sorted(fields))
+
+
+def _load_only(model_class, schema_class, fields, extra=()):
+    """Return a load_only() option loading the columns needed to dump `fields`.
+
+    Relationships need their foreign key columns. Return None if a
+    field does not map to a column or a relationship, in which case
+    all the columns must be loaded.
+    """
+    mapper = inspect(model_class)
+    attributes = set(extra)
+    for key in fields:
+        name = schema_class._declared_fields[key].attribute or key
+        prop = mapper.attrs[name] if name in mapper.attrs else None
+        if isinstance(prop, ColumnProperty):
+            attributes.add(prop.key)
+        elif isinstance(prop, RelationshipProperty):
+            attributes.update(mapper.get_property_by_column(c).key for c in prop.local_columns)
+        else:
+            return None
+    return load_only(*sorted(attributes))
+
+
+def _is_integer(value):
+    """Return True if `value` is an int that fits in a signed 64-bit database integer."""
+    return (isinstance(value, (int, long)) and not isinstance(value, bool) and
+            -2**63 <= value < 2**63)
+
+
+def _in_batches(ids):
+    ids = list(ids)
+    for start in range(0, len(ids), max_in_size):
+        yield ids[start:start + max_in_size]
+
+
+def permitted_ids(record_api, op, ids):
+    """Return the set of `ids`, as strings, of the records of `record_api` on which `op` is permitted.
+
+    The access control of `record_api` is applied with one query per
+    batch of :data:`max_in_size` ids. Ids of records that do not exist
+    are not returned.
+    """
+    model_class = record_api.model_class
+    access_control = record_api.access_control
+
+    query = model_class.query
+    if access_control is not None:
+        if access_control.denies(op, g.user, record_api.resource_name, model_class):
+            return set()
+        query = access_control.alter_query(op, query, g.user,
+                                           record_api.resource_name, model_class)
+    query = query.with_entities(model_class.id).distinct()
+    permitted = set()
+    for batch in _in_batches(ids):
+        permitted.update(unicode(row[0]) for row in query.filter(model_class.id.in_(batch)))
+    return permitted
+
+
+def _include_tree(value):
+    """Convert an ``include`` parameter like ``a,b.c`` to a tree like {'a': {}, 'b': {'c': {}}}."""
+    tree = dict()
+    for path in value.split(','):
+        path = path.strip()
+        if not path:
+            continue
+        node = tree
+        for name in path.split('.'):
+            node = node.setdefault(name, dict())
+    return tree
+
+
+def _get_relationship(record_api, name):
+    """Return the (relationship property, related RecordAPI) of the relationship field `name`."""
+    mapper = inspect(record_api.model_class)
+    for key, field in record_api.schema_class._declared_fields.items():
+        if name not in (key, underscores_to_dashes(key)) or not isinstance(field, BaseRelationship):
+            continue
+        attribute = field.attribute or key
+        prop = mapper.attrs[attribute] if attribute in mapper.attrs else None
+        related_api = registry.get(record_api.flask_restful_api, {}).get(getattr(field, 'type_', None))
+        if (isinstance(prop, RelationshipProperty) and related_api is not None and
+            prop.mapper.class_ is related_api.model_class):
+            return prop, related_api
+    abort(400, errors=["Cannot include '{0}'.".format(name)])
+
+
+def _check_include(record_api, tree=None):
+    """Abort with a 400 error if the ``include`` parameter names unknown relationships."""
+    if tree is None:
+        value = request.args.get('include')
+        if value is None:
+            return
+        tree = _include_tree(value)
+    for name, subtree in tree.items():
+        prop, related_api = _get_relationship(record_api, name)
+        _check_include(related_api, subtree)
+
+
+def _api_permits(record_api, op):
+    """Return True if the API level Acls of `record_api` grant `op` to the user."""
+    roles = WBUserModel.get_roles(g.user).names
+    return all(acl.check_any(roles, record_api.resource_name, op) for acl in record_api.acls)
+
+
+def _include(record_api, parents, tree, included):
+    """Load the records related to `parents` along the relationships of `tree`.
+
+    `parents` maps the ids of records of `record_api` to the records,
+    or to None if they are not loaded. For each relationship, the
+    related records are loaded with one query per batch of parents,
+    selected by an IN clause on the parent ids. The relationship of
+    the loaded parents is set to these records, so that dumping the
+    parents does not query them again.
+
+    The related records the user may read are added to `included`, a
+    { type: { id: record } } dict. Relationships to a resource that the
+    Acls of its API do not let the user read are left out.
+    """
+    parent_class = aliased(record_api.model_class)
+    for name, subtree in tree.items():
+        prop, related_api = _get_relationship(record_api, name)
+        if not _api_permits(related_api, 'read'):
+            continue
+
+        values = dict()
+        related = dict()
+        query = db.session.query(parent_class.id, related_api.model_class) \
+                          .join(getattr(parent_class, prop.key))
+        for batch in _in_batches(parents):
+            for parent_id, record in query.filter(parent_class.id.in_(batch)):
+                related[record.id] = record
+                values.setdefault(parent_id, []).append(record)
+
+        for parent_id, parent in parents.items():
+            if parent is not None:
+                value = values.get(parent_id, [])
+                if not prop.uselist:
+                    value = value[0] if value else None
+                set_committed_value(parent, prop.key, value)
+
+        permitted = permitted_ids(related_api, 'read', related)
+        records = dict((i, r) for i, r in related.items() if unicode(i) in permitted)
+        included.setdefault(related_api.schema_class.Meta.type_, dict()).update(records)
+        if subtree and records:
+            _include(related_api, records, subtree, included)
+
+
+def _compound_document(record_api, parents):
+    """Return the ``included`` list of the records requested by the ``include`` parameter.
+
+    Return None if the parameter is not given.
+    """
+    value = request.args.get('include')
+    if value is None:
+        return None
+    included = dict()
+    _include(record_api, parents, _include_tree(value), included)
+
+    result = []
+    for type_, records in sorted(included.items()):
+        related_api = registry[record_api.flask_restful_api][type_]
+        if related_api is record_api:
+            # Primary data must not be repeated in included.
+            records = dict((i, r) for i, r in records.items() if i not in parents)
+        if records:
+            schema = related_api.schema_class(only=_sparse_fields(related_api.schema_class))
+            result.extend(schema.dump([records[i] for i in sorted(records)], many=True).data['data'])
+    return result
+
 
 class RecordAPI(Resource):
     """Base class to expose a db.Model rendered by a JSONAPISchema through
@@ -27,8 +244,23 @@ class RecordAPI(Resource):
 
     then register the resource using flask_restful Api.add_resource.
 
+    GET supports JSON API sparse fieldsets: with ``fields[type]=a,b``,
+    only the id and the fields a and b are dumped, and only the columns
+    they need are loaded.
+
+    GET also supports JSON API compound documents: ``include=a,b.c``
+    adds the records related through the relationship fields a, b and
+    b.c of the schema to the ``included`` array. A relationship field
+    must be a marshmallow_jsonapi Relationship whose attribute is a
+    relationship of the model, and whose ``type_`` is a resource made
+    by :func:`make_api` on the same Api. Related records are loaded in
+    batches, and filtered by the Acls and the access control of their
+    resource.
+
     To define the LIST and POST operations, subclass RecordListAPI.
     """
+    # The woodbox.access_control.api.Acl instances of the api_authorizers.
+    acls = ()
 
     @classmethod
     def register_resource(cls, flask_restful_api):
@@ -38,23 +270,44 @@ class RecordAPI(Resource):
     def scoped_endpoint(cls):
         return '.' + cls.endpoint
 
-    def _get_item(self, item_id, operation, check_existence):
-        query = self.model_class.query
-        if self.access_control is not None:
-            query = self.access_control.alter_query(operation, query,
-                                                    g.user,
-                                                    self.resource_name,
-                                                    self.model_class)
-        item = query.filter_by(id=item_id).first()
+    def _get_item(self, item_id, operation, check_existence, fields=None):
+        model_class = self.model_class
+        option = None if fields is None else _load_only(model_class, self.schema_class, fields)
+        if self.access_control is None:
+            permitted = True
+        else:
+            permitted = self.access_control.permits(operation, g.user, self.resource_name,
+                                                    model_class, item_id)
 
         exists = None
-        if not item and check_existence:
+        if permitted is False:
+            item = None
+        elif permitted is True:
+            query = model_class.query
+            if option is not None:
+                query = query.options(option)
+            item = query.get(item_id)
+            exists = item is not None
+        else:
+            query = bakery(lambda session: session.query(model_class), model_class)
+            self.access_control.bake(query, operation,
+                                     g.user,
+                                     self.resource_name,
+                                     model_class)
+            query += lambda q: q.filter(model_class.id == bindparam('item_id'))
+            if option is not None:
+                query.add_criteria(lambda q: q.options(option), fields)
+            item = query(db.session()).params(item_id=item_id).first()
+
+        if not item and check_existence and exists is None:
             exists = self.model_class.query.get(item_id) != None
 
         return item, exists
 
     def get(self, item_id):
-        item, exists = self._get_item(item_id, 'read', check_existence=True)
+        fields = _sparse_fields(self.schema_class)
+        _check_include(type(self))
+        item, exists = self._get_item(item_id, 'read', check_existence=True, fields=fields)
 
         if not item:
             if exists is None:
@@ -64,7 +317,11 @@ class RecordAPI(Resource):
             else:
                 abort(403)
         else:
-            return self.schema_class().dump(item).data
+            included = _compound_document(type(self), {item.id: item})
+            result = self.schema_class(only=fields).dump(item).data
+            if included is not None:
+                result['included'] = included
+            return result
 
     def delete(self, item_id):
         item, exists = self._get_item(item_id, 'delete', check_existence=True)
@@ -89,7 +346,8 @@ class RecordAPI(Resource):
         if request.mimetype != 'application/vnd.api+json':
             return '', 415, {'Accept-Patch': 'application/vnd.api+json'}
 
-        input_data = request.get_json(force=True) or {}
+        # Do not keep the raw body around once it is parsed.
+        input_data = request.get_json(force=True, cache=False) or {}
         schema = self.schema_class()
 
         try:
@@ -137,13 +395,113 @@ class RecordListAPI(Resource):
     To define the GET (single record), DELETE and PATCH operations,
     subclass RecordAPI.
 
+    Lists are paginated with the ``page[size]`` and ``page[after]``
+    query parameters, and sorted by id or by the field named by the
+    ``sort`` parameter (``-`` prefixed for descending order), which
+    must be an indexed column. A page holds at most
+    :attr:`max_page_size` records, or the ``WOODBOX_MAX_PAGE_SIZE``
+    configuration value. When more records follow, ``links.next``
+    holds the URL of the next page.
+
+    Like RecordAPI, lists support sparse fieldsets and compound documents.
+
+    If :attr:`streaming` is True, the list is serialized one record
+    at a time while it is sent, instead of being built in memory.
+
     """
+    # Query parameters that are not record filters, in addition to
+    # the parameter families like page[...].
+    reserved_parameters = ('sort', 'include')
+
+    max_page_size = 1000
+
+    streaming = False
+    # Number of records loaded at a time when streaming.
+    stream_batch_size = 100
+    # Approximate size of the chunks written when streaming.
+    stream_chunk_size = 64 * 1024
 
     @classmethod
     def register_resource(cls, flask_restful_api):
         flask_restful_api.add_resource(cls, '/' + cls.schema_class.Meta.type_)
 
-    def get(self):
+    def _get_sort_key(self):
+        """Return the (column, descending) pair requested by the ``sort`` parameter.
+
+        Return (None, False) if the records are sorted by id.
+        """
+        sort = request.args.get('sort')
+        if not sort:
+            return None, False
+        descending = sort.startswith('-')
+        name = sort[1:] if descending else sort
+        for key, field in self.schema_class._declared_fields.items():
+            if name in (key, underscores_to_dashes(key)):
+                attribute = getattr(self.model_class, field.attribute or key, None)
+                break
+        else:
+            attribute = None
+
+        columns = getattr(getattr(attribute, 'property', None), 'columns', None)
+        if columns and self._is_sortable(columns[0]):
+            return attribute, descending
+        abort(400, errors=["Cannot sort on '{0}'.".format(name)])
+
+    @staticmethod
+    def _is_sortable(column):
+        """Records can be paginated on non nullable, indexed, integer or string columns."""
+        if column.nullable or not isinstance(column.type, (Integer, String)):
+            return False
+        return (column.primary_key or column.index or column.unique or
+                any(list(i.columns)[0] is column for i in column.table.indexes))
+
+    @staticmethod
+    def _encode_cursor(value):
+        return base64.urlsafe_b64encode(json.dumps(value).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def _decode_cursor(cursor, key):
+        """Return the cursor made by :meth:`_encode_cursor`: an id, or a [sort key value, id] pair.
+
+        Abort with a 400 error if the cursor does not have the type of
+        the sort key, or an integer out of the range of the database
+        integers, which could make the query fail.
+        """
+        try:
+            value = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+        except (TypeError, ValueError, binascii.Error):
+            value = None
+        if key is None:
+            if _is_integer(value):
+                return value
+        elif isinstance(value, list) and len(value) == 2 and _is_integer(value[1]):
+            if isinstance(key.property.columns[0].type, Integer):
+                valid = _is_integer(value[0])
+            else:
+                valid = isinstance(value[0], basestring)
+            if valid:
+                return value
+        abort(400, errors=["Invalid page[after] cursor."])
+
+    def _get_page_size(self):
+        max_page_size = current_app.config.get('WOODBOX_MAX_PAGE_SIZE', self.max_page_size)
+        size = request.args.get('page[size]')
+        if size is None:
+            return max_page_size
+        try:
+            size = int(size)
+        except ValueError:
+            size = 0
+        if size < 1:
+            abort(400, errors=["page[size] must be a positive integer."])
+        return min(size, max_page_size)
+
+    def _get_page_query(self, fields):
+        """Return the (query, sort key, page size) of the requested page.
+
+        The query returns up to page size + 1 records: the extra
+        record tells that there is a next page.
+        """
         query = self.model_class.query
         if self.access_control is not None:
             query = self.access_control.alter_query('read', query,
@@ -153,19 +511,122 @@ class RecordListAPI(Resource):
 
         # Filter using query parameters
         for args, value in request.args.iteritems():
+            if args in self.reserved_parameters or '[' in args:
+                continue
             c = getattr(self.model_class, self.schema_class._declared_fields[args].attribute)
             if value == '':
                 value = None
             query = query.filter(c == value)
 
+        # Keyset pagination: order by the sort key and the id, and
+        # start after the last record of the previous page.
+        id_column = self.model_class.id
+        key, descending = self._get_sort_key()
+        after = request.args.get('page[after]')
+        if after is not None:
+            cursor = self._decode_cursor(after, key)
+            if key is None:
+                query = query.filter(id_column > cursor)
+            else:
+                value, last_id = cursor
+                query = query.filter(or_(key < value if descending else key > value,
+                                         and_(key == value, id_column > last_id)))
+        if key is None:
+            query = query.order_by(id_column)
+        else:
+            query = query.order_by(key.desc() if descending else key, id_column)
+
+        if fields is not None:
+            option = _load_only(self.model_class, self.schema_class, fields,
+                                extra=() if key is None else (key.key,))
+            if option is not None:
+                query = query.options(option)
+
+        size = self._get_page_size()
+        return query.limit(size + 1), key, size
+
+    def _next_link(self, last, key):
+        """Return the URL of the page following the `last` record."""
+        if key is None:
+            cursor = last.id
+        else:
+            cursor = [getattr(last, key.key), last.id]
+        args = request.args.copy()
+        args['page[after]'] = self._encode_cursor(cursor)
+        return request.path + '?' + url_encode(args)
+
+    def _stream(self, query, key, size, fields):
+        """Generate the JSON document of the page, one record at a time.
+
+        Records are loaded :attr:`stream_batch_size` at a time, and the
+        output is yielded in chunks of about :attr:`stream_chunk_size`
+        characters, so that the WSGI server does not write many tiny
+        pieces.
+        """
+        schema = self.schema_class(only=fields)
+        chunk = ['{"data": [']
+        length = 0
+        last = None
+        ids = []
+        has_next = False
+        # The query is always consumed to the end (it returns at most
+        # size + 1 records), so that its cursor is released.
+        for i, item in enumerate(query.yield_per(self.stream_batch_size)):
+            if i == size:
+                has_next = True
+                continue
+            record = json.dumps(schema.dump(item).data['data'])
+            chunk.append(', ' + record if i else record)
+            length += len(record)
+            if length >= self.stream_chunk_size:
+                yield ''.join(chunk)
+                chunk = []
+                length = 0
+            last = item
+            ids.append(item.id)
+        chunk.append(']')
+        if has_next:
+            chunk.append(', "links": ' + json.dumps({'next': self._next_link(last, key)}))
+        # Included records are loaded from the ids of the records once
+        # they are all sent.
+        included = _compound_document(self.record_api, dict.fromkeys(ids))
+        if included is not None:
+            chunk.append(', "included": ' + json.dumps(included))
+        chunk.append('}\n')
+        yield ''.join(chunk)
+
+    def get(self):
+        fields = _sparse_fields(self.schema_class)
+        _check_include(self.record_api)
+        if self.access_control is not None and self.access_control.denies('read', g.user,
+                                                                          self.resource_name,
+                                                                          self.model_class):
+            result = self.schema_class().dump([], many=True).data
+            if 'include' in request.args:
+                result['included'] = []
+            return result
+
+        query, key, size = self._get_page_query(fields)
+
+        if self.streaming:
+            return Response(stream_with_context(self._stream(query, key, size, fields)),
+                            mimetype='application/json')
+
         items = query.all()
-        return self.schema_class().dump(items, many=True).data
+        included = _compound_document(self.record_api, dict((i.id, i) for i in items[:size]))
+        result = self.schema_class(only=fields).dump(items[:size], many=True).data
+        if len(items) > size:
+            result['links'] = {'next': self._next_link(items[size - 1], key)}
+        if included is not None:
+            result['included'] = included
+        return result
 
     def post(self):
         if request.mimetype != 'application/vnd.api+json':
             return '', 415, {'Accept-Patch': 'application/vnd.api+json'}
 
-        input_data = request.get_json(force=True) or {}
+        # Do not keep the raw body around once it is parsed.
+        input_data = request.get_json(force=True, cache=False) or {}
         schema = self.schema_class()
 
         try:
@@ -184,14 +645,18 @@ class RecordListAPI(Resource):
 
 
 def make_api(flask_restful_app, name, model_class, schema_class,
-             api_authorizers=None, record_authorizer=None):
+             api_authorizers=None, record_authorizer=None, streaming=False):
     """Helper function to build an API for a schema.
 
+    Return the RecordAPI and RecordListAPI subclasses.
+
     record_authorizer: instance of a woodbox.access_control.record.RecordAccessControl.
 
     api_authorizers: list of decorators, for example the authorize()
     member of an woodbox.access_control.api.Acl.
 
+    streaming: if True, lists are streamed (see RecordListAPI).
+
     """
     # TODO: we could have a schema_class per role
     if api_authorizers is None:
@@ -199,6 +664,8 @@ def make_api(flask_restful_app, name, model_class, schema_class,
     else:
         method_decorators = api_authorizers
     method_decorators.append(HMACAuthenticator.authenticate)
+    acls = tuple(getattr(authorizer, '__self__', None) for authorizer in method_decorators)
+    acls = tuple(acl for acl in acls if isinstance(acl, Acl))
 
     # Create a subclass of Record[List]API and register the resource with the app.
     t = type(str(name+'API'), (RecordAPI,),
@@ -206,15 +673,104 @@ def make_api(flask_restful_app, name, model_class, schema_class,
               'resource_name': name,
               'model_class': model_class,
               'schema_class': schema_class,
-              'access_control': record_authorizer
+              'access_control': record_authorizer,
+              'acls': acls,
+              'flask_restful_api': flask_restful_app
              })
     t.register_resource(flask_restful_app)
+    registry.setdefault(flask_restful_app, dict())[schema_class.Meta.type_] = t
     t = type(str(name+'ListAPI'), (RecordListAPI,),
              {'method_decorators': method_decorators,
               'resource_name': name,
               'model_class': model_class,
               'schema_class': schema_class,
               'access_control': record_authorizer,
-              'record_api': t
+              'acls': acls,
+              'record_api': t,
+              'flask_restful_api': flask_restful_app,
+              'streaming': streaming
              })
     t.register_resource(flask_restful_app)
+    return t.record_api, t
+
+
+class PermissionAPI(Resource):
+    """Tell which operations the user may do on a list of records.
+
+    POST a JSON document listing the records and operations to check::
+
+        {"permissions": [{"type": "my-tests", "id": "1", "op": "update"},
+                         {"type": "my-tests", "id": "2", "op": "delete"}]}
+
+    The answer maps types, ids and operations to booleans::
+
+        {"permissions": {"my-tests": {"1": {"update": true},
+                                      "2": {"delete": false}}}}
+
+    The records are checked with one query per type and operation,
+    using the Acls and the access control of the RecordAPI registered
+    by :func:`make_api` for the type. Records that do not exist are not
+    permitted. Ids must be integers, and a request may check at most
+    :attr:`max_checks` permissions.
+
+    To create the resource, use :func:`make_permission_api`.
+    """
+    operations = ('read', 'update', 'delete')
+
+    # Maximum number of checks in one request.
+    max_checks = 1000
+
+    def _permitted_ids(self, record_api, op, ids):
+        """Return the set of the ids, as strings, on which `op` is permitted."""
+        if not _api_permits(record_api, op):
+            return set()
+        return permitted_ids(record_api, op, ids)
+
+    def post(self):
+        input_data = request.get_json(force=True, cache=False) or {}
+        checks = input_data.get('permissions') if isinstance(input_data, dict) else None
+        if not isinstance(checks, list):
+            abort(400, errors=["Missing permissions list."])
+        if len(checks) > self.max_checks:
+            abort(400, errors=["Too many permissions to check (maximum {0}).".format(self.max_checks)])
+
+        resources = registry.get(self.flask_restful_api, {})
+        ids = defaultdict(set)
+        for check in checks:
+            try:
+                item_type, item_id, op = check['type'], check['id'], check['op']
+            except (KeyError, TypeError):
+                abort(400, errors=["Permissions must have a type, an id and an op."])
+            # Record ids are database integers: anything else would
+            # make the database fail on the IN clause.
+            try:
+                item_id = int(unicode(item_id))
+            except ValueError:
+                pass
+            if not _is_integer(item_id):
+                abort(400, errors=["Invalid id '{0}'.".format(check['id'])])
+            if not isinstance(item_type, basestring) or item_type not in resources:
+                abort(400, errors=["Unknown type '{0}'.".format(item_type)])
+            if not isinstance(op, basestring) or op not in self.operations:
+                abort(400, errors=["Unknown operation '{0}'.".format(op)])
+            ids[(item_type, op)].add(item_id)
+
+        permissions = dict()
+        for (item_type, op), item_ids in ids.items():
+            permitted = self._permitted_ids(resources[item_type], op, item_ids)
+            records = permissions.setdefault(item_type, dict())
+            for item_id in item_ids:
+                item_id = unicode(item_id)
+                records.setdefault(item_id, dict())[op] = item_id in permitted
+
+        return {'permissions': permissions}
+
+
+def make_permission_api(flask_restful_app, url='/permissions'):
+    """Helper function to add a PermissionAPI for the resources made by :func:`make_api`."""
+    t = type(str('PermissionAPI'), (PermissionAPI,),
+             {'method_decorators': [HMACAuthenticator.authenticate],
+              'flask_restful_api': flask_restful_app
+             })
+    flask_restful_app.add_resource(t, url)
+    return t
@@ -6,13 +6,20 @@ from flask import jsonify, request
 from .db import db
 from .models.session_model import WBSessionModel
 from .models.user_model import WBUserModel
+from .password_hasher import PasswordHasherBusy
+from .stateless_session import StatelessSession
 
 
 def authenticate():
     """View function to authenticate user.
 
     If authentication is successful, a new session is created and
-    returned as a response.
+    returned as a response. The stored password hash is upgraded if it
+    does not use the current format and cost, and if the database
+    column is wide enough (see :meth:`WBUserModel.upgrade_password`).
+
+    If too many passwords are waiting to be hashed, answer with a 503
+    error without checking the password.
 
     """
     try:
@@ -22,8 +29,28 @@ def authenticate():
         return jsonify(err=2, message="Missing parameter.")
 
     user = WBUserModel.query.filter_by(username=name).first()
-    hashed_password = WBUserModel.hash_password(password)
-    if user and user.hashed_password == hashed_password:
+    try:
+        if user:
+            valid = user.check_password(password)
+            if valid and user.upgrade_password(password):
+                db.session.commit()
+        else:
+            # Hash the password anyway, so that the response time does
+            # not tell whether the user exists.
+            WBUserModel.hash_password(password)
+            valid = False
+    except PasswordHasherBusy:
+        response = jsonify(err=5, message="Server busy, try again later.")
+        response.status_code = 503
+        response.headers['Retry-After'] = '1'
+        return response
+    if valid:
+        if StatelessSession.enabled():
+            session_id, secret = StatelessSession.issue(user.id)
+            return jsonify(username=name, err=0,
+                           session_id=session_id,
+                           session_secret=secret)
+
         session = WBSessionModel(user_id=user.id)
         db.session.add(session)
         db.session.commit()
@@ -37,6 +64,14 @@ def authenticate():
 def validate_session():
     """View function to check if session id refers to a valid session."""
     session_id = request.form['session_id']
+    if StatelessSession.is_stateless(session_id):
+        credentials = StatelessSession.get_credentials(session_id)
+        if credentials:
+            return jsonify(err=0,
+                           session_id=session_id,
+                           session_secret=credentials.secret)
+        return jsonify(err=3, message="Invalid session.")
+
     session = WBSessionModel.query.filter_by(session_id=session_id).first()
     if session and session.touch():
         return jsonify(err=0,
@@ -49,6 +84,10 @@ def validate_session():
 def invalidate_session():
     """View function to delete the session referenced in the request."""
     session_id = request.form['session_id']
+    if StatelessSession.is_stateless(session_id):
+        StatelessSession.revoke(session_id)
+        return jsonify(err=0)
+
     session = WBSessionModel.query.filter_by(session_id=session_id).first()
     if session:
         count = db.session.delete(session)
@@ -56,6 +95,9 @@ def invalidate_session():
         if count == 0:
             return jsonify(err=4, message="Session could not be deleted.")
 
+    # Evict after the commit: until then, concurrent requests may
+    # still load the session and cache its credentials.
+    WBSessionModel.credential_cache.evict(session_id)
     return jsonify(err=0)
 
 
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import time
+
+from twisted.internet import reactor as default_reactor
+from twisted.internet.threads import deferToThreadPool
+from twisted.logger import Logger
+log = Logger()
+
+from .models.session_model import WBSessionModel
+
+
+class SessionSweeper(object):
+    """Periodically delete expired sessions.
+
+    Every `interval` seconds, the sweeper deletes expired sessions in
+    batches of `batch_size`, at most `max_batches` batches per run. The
+    deletion runs in the reactor thread pool.
+
+    When requests are waiting for a thread of the pool, the sweep is
+    postponed, doubling the interval up to `max_interval`. It also
+    stops deleting batches as soon as requests are waiting.
+
+    Example::
+
+        SessionSweeper(app, interval=60).start()
+
+    """
+    def __init__(self, app, interval=60, batch_size=1000, max_batches=10,
+                 max_interval=None, reactor=None, threadpool=None):
+        self.app = app
+        self.interval = interval
+        self.current_interval = interval
+        self.batch_size = batch_size
+        self.max_batches = max_batches
+        self.max_interval = max_interval if max_interval is not None else 16 * interval
+        self.reactor = reactor if reactor is not None else default_reactor
+        self.threadpool = threadpool if threadpool is not None else self.reactor.getThreadPool()
+
+        self.last_removed = 0
+        self.last_duration = 0.0
+        self.total_removed = 0
+        self._call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def is_busy(self):
+        return self.threadpool.q.qsize() > 0
+
+    def _schedule(self):
+        self._call = self.reactor.callLater(self.current_interval, self._run)
+
+    def _run(self):
+        if self.is_busy():
+            self.current_interval = min(2 * self.current_interval, self.max_interval)
+            log.info("Session sweep postponed by {interval} seconds: server is busy.",
+                     interval=self.current_interval)
+            self._schedule()
+            return
+
+        self.current_interval = self.interval
+        d = deferToThreadPool(self.reactor, self.threadpool, self.sweep)
+        d.addErrback(lambda failure: log.failure("Session sweep failed.", failure))
+        d.addBoth(lambda _: self._schedule())
+
+    def sweep(self):
+        """Delete expired sessions. Return the number of sessions deleted."""
+        start = time.time()
+        removed = 0
+        with self.app.app_context():
+            for i in range(self.max_batches):
+                count = WBSessionModel.delete_expired(self.batch_size)
+                removed += count
+                if count < self.batch_size or self.is_busy():
+                    break
+
+        self.last_removed = removed
+        self.last_duration = time.time() - start
+        self.total_removed += removed
+        log.info("Session sweep removed {removed} sessions in {duration:.3f} seconds.",
+                 removed=removed, duration=self.last_duration)
+        return removed
+
+
+class AccessTimeFlusher(object):
+    """Periodically write the access times pending in a SessionAccessRecorder.
+
+    Without it, the access times of a process that stops receiving
+    requests are only written at shutdown, and the sessions can be
+    expired meanwhile. The writes run in the reactor thread pool.
+
+    Example::
+
+        AccessTimeFlusher(app, WBSessionModel.access_recorder).start()
+
+    """
+    def __init__(self, app, recorder, interval=None, reactor=None, threadpool=None):
+        self.app = app
+        self.recorder = recorder
+        self.interval = interval if interval is not None else recorder.flush_interval
+        self.reactor = reactor if reactor is not None else default_reactor
+        self.threadpool = threadpool if threadpool is not None else self.reactor.getThreadPool()
+        self._call = None
+
+    def start(self):
+        self._schedule()
+
+    def stop(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+    def _schedule(self):
+        self._call = self.reactor.callLater(self.interval, self._run)
+
+    def _run(self):
+        d = deferToThreadPool(self.reactor, self.threadpool, self.flush)
+        d.addErrback(lambda failure: log.failure("Session access time flush failed.", failure))
+        d.addBoth(lambda _: self._schedule())
+
+    def flush(self):
+        """Write the pending access times. Return the number of sessions written."""
+        with self.app.app_context():
+            return self.recorder.flush()
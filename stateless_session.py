@@ -0,0 +1,154 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import binascii
+import heapq
+import os
+import threading
+import time
+
+from hashlib import sha256
+from hmac import new as hmac_new
+
+from flask import current_app
+
+from .models.session_model import SessionCredentials
+from .utils.cache import TTLCache
+from .utils.compare_digest import compare_digest
+from .utils.hkdf import hkdf_sha256
+
+
+class RevocationList(object):
+    """A set of revoked credentials, each kept until it expires."""
+    def __init__(self, timer=time.time):
+        self.timer = timer
+        self._expiries = dict()   # credential -> expiry
+        self._heap = []           # (expiry, credential), soonest first
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._expiries)
+
+    def __contains__(self, credential):
+        return credential in self._expiries
+
+    def add(self, credential, expiry):
+        with self._lock:
+            now = self.timer()
+            while self._heap and self._heap[0][0] < now:
+                _, c = heapq.heappop(self._heap)
+                del self._expiries[c]
+            if credential not in self._expiries and expiry >= now:
+                self._expiries[credential] = expiry
+                heapq.heappush(self._heap, (expiry, credential))
+
+
+class StatelessSession(object):
+    """Sessions that are not stored in the database.
+
+    When the ``WOODBOX_SESSION_MASTER_KEY`` configuration value is set,
+    :func:`woodbox.session.authenticate` issues credentials of the form
+    ``wbs1.<user id>.<expiry>.<nonce>.<tag>``, where the tag is an
+    HMAC of the rest of the credential, keyed with a signing key
+    derived from the master key. The session secret is derived from
+    the master key and the credential with HKDF-SHA256, so that a
+    request can be verified without accessing the database, by any
+    worker sharing the master key. Credentials whose tag does not
+    match were not issued by a worker sharing the master key, and are
+    rejected before any secret is derived.
+
+    Stateless sessions expire :attr:`lifetime` seconds after they are
+    issued. Sessions invalidated before that are kept in
+    :attr:`revoked`, which is local to the process: when requests are
+    served by several processes, an invalidated session stays valid in
+    the other processes until it expires. Use database sessions if
+    invalidation must be immediate everywhere.
+
+    """
+    prefix = 'wbs1.'
+
+    lifetime = 60*60
+
+    revoked = RevocationList()
+
+    # Cache of credential -> SessionCredentials, to skip the key derivation.
+    credential_cache = TTLCache(maxsize=10000, ttl=60)
+
+    @staticmethod
+    def enabled():
+        return bool(current_app.config.get('WOODBOX_SESSION_MASTER_KEY'))
+
+    @classmethod
+    def is_stateless(cls, credential):
+        return credential.startswith(cls.prefix)
+
+    @staticmethod
+    def _master_key():
+        return current_app.config['WOODBOX_SESSION_MASTER_KEY'].encode('utf-8')
+
+    @classmethod
+    def derive_secret(cls, credential):
+        return binascii.hexlify(hkdf_sha256(cls._master_key(), info=credential.encode('utf-8')))
+
+    @classmethod
+    def sign(cls, payload):
+        """Return the tag of the credential `payload`, as hexadecimal."""
+        signing_key = hkdf_sha256(cls._master_key(), info=b'woodbox session credential tag')
+        return hmac_new(signing_key, payload.encode('utf-8'), sha256).hexdigest()
+
+    @classmethod
+    def issue(cls, user_id):
+        """Return a (credential, secret) pair for a new session of `user_id`."""
+        expiry = int(time.time()) + cls.lifetime
+        payload = '{}{}.{}.{}'.format(cls.prefix, user_id, expiry, binascii.hexlify(os.urandom(8)))
+        credential = '{}.{}'.format(payload, cls.sign(payload))
+        return credential, cls.derive_secret(credential)
+
+    @classmethod
+    def parse(cls, credential):
+        """Return the (user_id, expiry) pair encoded in `credential`.
+
+        Return None if `credential` is malformed or if its tag does not match.
+        """
+        if not cls.enabled() or not cls.is_stateless(credential):
+            return None
+        payload, _, tag = credential.rpartition('.')
+        parts = payload[len(cls.prefix):].split('.')
+        if len(parts) != 3:
+            return None
+        try:
+            tag = tag.encode('ascii')
+        except UnicodeError:
+            return None
+        if not compare_digest(tag, cls.sign(payload).encode('ascii')):
+            return None
+        try:
+            return int(parts[0]), int(parts[1])
+        except ValueError:
+            return None
+
+    @classmethod
+    def get_credentials(cls, credential):
+        """Return the SessionCredentials for `credential`, or None if it is invalid, expired or revoked."""
+        parsed = cls.parse(credential)
+        if parsed is None:
+            return None
+        user_id, expiry = parsed
+        now = time.time()
+        if expiry < now or expiry > now + cls.lifetime or credential in cls.revoked:
+            return None
+
+        credentials = cls.credential_cache.get(credential)
+        if credentials is None:
+            secret = cls.derive_secret(credential)
+            credentials = SessionCredentials(secret, user_id, None,
+                                             hmac_new(secret, digestmod=sha256))
+            cls.credential_cache.set(credential, credentials)
+        return credentials
+
+    @classmethod
+    def revoke(cls, credential):
+        parsed = cls.parse(credential)
+        if parsed is not None:
+            cls.revoked.add(credential, parsed[1])
+            cls.credential_cache.evict(credential)
@@ -2,6 +2,7 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import json
+import unittest
 
 from hashlib import sha256, sha1
 from hmac import new as hmac_new
@@ -14,6 +15,7 @@ from woodbox.authenticator import HMACAuthenticator
 from woodbox.db import db
 from woodbox.models.session_model import WBSessionModel
 from woodbox.models.user_model import WBUserModel
+from woodbox.nonce_store import MemoryNonceStore
 from woodbox.session import add_session_management_urls
 from woodbox.tests.flask_test_case import FlaskTestCase
 
@@ -25,6 +27,16 @@ def needs_authenticated_user_function():
     else:
         return 'anonymous'
 
+@HMACAuthenticator.authenticate
+def needs_authenticated_user_echo_function():
+    return '{} {}'.format(g.user, len(request.get_data()))
+
+def undecorated_function():
+    if g.user:
+        return str(g.user)
+    else:
+        return 'anonymous'
+
 
 class AuthenticatorTestCase(FlaskTestCase):
     def setUp(self):
@@ -32,6 +44,7 @@ class AuthenticatorTestCase(FlaskTestCase):
 
         add_session_management_urls(self.app)
         self.app.add_url_rule('/test', 'test', needs_authenticated_user_function, methods=['GET'])
+        self.app.add_url_rule('/echo', 'echo', needs_authenticated_user_echo_function, methods=['POST'])
 
         with self.app.test_request_context('/'):
             db.initialize()
@@ -67,6 +80,109 @@ class AuthenticatorTestCase(FlaskTestCase):
             self.assertEqual(g.user_reason, 'Authenticated')
             self.assertEqual(response.data, '1', g.user_reason)
 
+    def test_authenticator_precomputed_signer(self):
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            signer = HMACAuthenticator.keyed_hmac(response['session_secret'])
+
+            for i in range(2):
+                auth_headers = HMACAuthenticator.get_authorization_headers(session_id, None,
+                                                                           '/test', signer=signer)
+                response = c.get('/test', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Authenticated')
+                self.assertEqual(response.data, '1', g.user_reason)
+
+    def test_authenticator_spooled_body(self):
+        self.app.config['WOODBOX_BODY_SPOOL_SIZE'] = 1024
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            secret = response['session_secret']
+
+            body = 'x' * 200000
+            auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/echo',
+                                                                       method='POST', body=body)
+            response = c.post('/echo', data=body, headers=auth_headers)
+            self.assertEqual(g.user_reason, 'Authenticated')
+            self.assertEqual(response.data, '1 200000', g.user_reason)
+
+    def test_authenticator_body_too_large(self):
+        self.app.config['MAX_CONTENT_LENGTH'] = 1000
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            secret = response['session_secret']
+
+            body = 'x' * 1001
+            auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/echo',
+                                                                       method='POST', body=body)
+            response = c.post('/echo', data=body, headers=auth_headers)
+            self.assertEqual(response.status_code, 413)
+
+    def test_authenticator_before_request(self):
+        HMACAuthenticator.init_app(self.app)
+        self.app.add_url_rule('/undecorated', 'undecorated', undecorated_function, methods=['GET'])
+        HMACAuthenticator.nonce_store = MemoryNonceStore()
+        try:
+            with self.app.test_client() as c:
+                response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+                response = json.loads(response.data)
+                session_id = response['session_id']
+                secret = response['session_secret']
+
+                response = c.get('/undecorated')
+                self.assertEqual(response.data, 'anonymous')
+
+                auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/undecorated')
+                response = c.get('/undecorated', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Authenticated')
+                self.assertEqual(response.data, '1', g.user_reason)
+
+                # The decorator must not verify the request a second time.
+                auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/test')
+                response = c.get('/test', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Authenticated')
+                self.assertEqual(response.data, '1', g.user_reason)
+
+                auth_headers['x-woodbox-timestamp'] = 'garbage'
+                response = c.get('/undecorated', headers=auth_headers)
+                self.assertEqual(response.status_code, 401)
+        finally:
+            HMACAuthenticator.nonce_store = None
+
+    def test_authenticator_replay(self):
+        HMACAuthenticator.nonce_store = MemoryNonceStore()
+        try:
+            with self.app.test_client() as c:
+                response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+                response = json.loads(response.data)
+                session_id = response['session_id']
+                secret = response['session_secret']
+
+                auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/test')
+                response = c.get('/test', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Authenticated')
+                self.assertEqual(response.data, '1', g.user_reason)
+
+                response = c.get('/test', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Request was already received.')
+                self.assertEqual(response.data, 'anonymous', g.user_reason)
+
+                # Variants of the signature are not accepted as new requests.
+                credential, signature = auth_headers['Authorization'].split('Signature=')
+                for variant in (signature[:10] + '\xe9' + signature[10:], signature.upper(),
+                                signature + ' ', '0' + signature):
+                    headers = dict(auth_headers, Authorization=credential + 'Signature=' + variant)
+                    response = c.get('/test', headers=headers)
+                    self.assertEqual(response.data, 'anonymous', variant)
+                    self.assertIn(g.user_reason, ('Invalid signature.', 'Request was already received.'))
+        finally:
+            HMACAuthenticator.nonce_store = None
+
     def test_authenticator_unsorted_query_string(self):
         with self.app.test_client() as c:
             response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
@@ -500,3 +616,18 @@ class AuthenticatorTestCase(FlaskTestCase):
             response = c.get('/test', headers=request_headers)
             self.assertEqual(g.user_reason, 'Content hash does not match.')
             self.assertEqual(response.data, 'anonymous', g.user_reason)
+
+
+class TimestampTestCase(unittest.TestCase):
+    def test_parse_timestamp(self):
+        t = 1453497123
+        self.assertEqual(HMACAuthenticator.parse_timestamp('20160122T211203Z'), t)
+        self.assertEqual(HMACAuthenticator.parse_timestamp('20160122T211203'), t)
+        self.assertEqual(HMACAuthenticator.parse_timestamp('20160122T211203+0000'), t)
+        self.assertEqual(HMACAuthenticator.parse_timestamp('20160122T221203+0100'), t)
+        self.assertEqual(HMACAuthenticator.parse_timestamp('20160122T163203-0440'), t)
+        self.assertEqual(HMACAuthenticator.parse_timestamp(HMACAuthenticator.format_timestamp(t)), t)
+
+    def test_parse_invalid_timestamp(self):
+        for timestamp in ['', '2016-01-22T21:12:03Z', '20160122 211203', '20160122T211203 UTC', '20160122T2112ab']:
+            self.assertRaises(ValueError, HMACAuthenticator.parse_timestamp, timestamp)
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from woodbox.nonce_store import MemoryNonceStore, SQLiteNonceStore
+
+
+class NonceStoreTests(object):
+    def setUp(self):
+        self.now = 1000
+
+    def timer(self):
+        return self.now
+
+    def test_replay(self):
+        self.assertTrue(self.store.add('a:1', self.now))
+        self.assertTrue(self.store.add('a:2', self.now))
+        self.assertFalse(self.store.add('a:1', self.now))
+        self.assertFalse(self.store.add('a:2', self.now))
+
+    def test_expiration(self):
+        self.assertTrue(self.store.add('a:1', self.now))
+        self.now += 60
+        self.assertFalse(self.store.add('a:1', self.now - 60))
+        self.now += 60
+        self.assertTrue(self.store.add('a:1', self.now - 120))
+
+
+class MemoryNonceStoreTestCase(NonceStoreTests, unittest.TestCase):
+    def setUp(self):
+        super(MemoryNonceStoreTestCase, self).setUp()
+        self.store = MemoryNonceStore(shards=4, window=60, bucket_width=10, timer=self.timer)
+
+    def test_buckets_are_dropped(self):
+        for i in range(100):
+            self.store.add('a:{}'.format(i), self.now)
+        self.assertEqual(len(self.store), 100)
+        self.now += 120
+        self.store.expire()
+        self.assertEqual(len(self.store), 0)
+
+
+class SQLiteNonceStoreTestCase(NonceStoreTests, unittest.TestCase):
+    def setUp(self):
+        super(SQLiteNonceStoreTestCase, self).setUp()
+        self.tmp_dir = tempfile.mkdtemp()
+        self.store = SQLiteNonceStore(os.path.join(self.tmp_dir, 'nonces.sqlite'),
+                                      window=60, bucket_width=10, timer=self.timer)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import unittest
+
+from woodbox.password_hasher import PasswordHasher, PasswordHasherBusy, calibrate_iterations
+from woodbox.utils.pbkdf2_hmac import pbkdf2_hmac
+
+
+class PasswordHasherTestCase(unittest.TestCase):
+    def test_inline(self):
+        hasher = PasswordHasher()
+        self.assertEqual(hasher.pbkdf2_hmac(str('sha256'), b'password', b'salt', 10),
+                         pbkdf2_hmac(str('sha256'), b'password', b'salt', 10))
+        self.assertEqual(hasher.stats()['hashed'], 1)
+        self.assertEqual(hasher.stats()['pending'], 0)
+
+    def test_pool(self):
+        hasher = PasswordHasher(processes=1)
+        try:
+            self.assertEqual(hasher.pbkdf2_hmac(str('sha256'), b'password', b'salt', 10),
+                             pbkdf2_hmac(str('sha256'), b'password', b'salt', 10))
+            self.assertEqual(hasher.stats()['hashed'], 1)
+            self.assertGreater(hasher.stats()['mean_latency'], 0)
+        finally:
+            hasher.close()
+
+    def test_busy(self):
+        hasher = PasswordHasher(processes=1, max_pending=0)
+        self.assertRaises(PasswordHasherBusy, hasher.pbkdf2_hmac, str('sha256'), b'password', b'salt', 10)
+        self.assertEqual(hasher.stats()['rejected'], 1)
+        self.assertEqual(hasher.stats()['hashed'], 0)
+
+    def test_calibrate_iterations(self):
+        iterations, elapsed = calibrate_iterations(0.01, min_time=0.001)
+        self.assertGreaterEqual(iterations, 1000)
+        self.assertEqual(iterations % 1000, 0)
@@ -1,10 +1,12 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import base64
 import json
 
 from flask import g
 from flask_restful import Api
+from sqlalchemy import event
 from marshmallow.validate import Length
 from marshmallow_jsonapi import fields
 
@@ -14,7 +16,7 @@ from woodbox.authenticator import HMACAuthenticator
 from woodbox.db import db
 from woodbox.jsonapi_schema import JSONAPISchema
 from woodbox.models.user_model import WBRoleModel, WBUserModel
-from woodbox.record_api import make_api
+from woodbox.record_api import make_api, make_permission_api
 from woodbox.session import add_session_management_urls
 from woodbox.tests.flask_test_case import FlaskTestCase
 
@@ -34,6 +36,17 @@ class MyTestSchema(JSONAPISchema):
     owner = fields.Nested('UserSchema', many=False)
     owner_id = fields.Integer(attribute='owner_id')
 
+class PersonSchema(JSONAPISchema):
+    username = fields.String(attribute='username')
+    roles = fields.Relationship(type_='roles', many=True, include_data=True)
+
+class RoleSchema(JSONAPISchema):
+    rolename = fields.String(attribute='rolename')
+
+class BookSchema(JSONAPISchema):
+    title = fields.String(attribute='title')
+    owner = fields.Relationship(type_='people', include_data=True)
+
 my_test_acl = Acl()
 my_test_acl.grants({
     'admin': {
@@ -390,3 +403,275 @@ class RecordAPITestCase(FlaskTestCase):
             headers['Content-Type'] = 'application/vnd.api+json'
             response = c.post('/my-tests', data=post_data, headers=headers)
             self.assertEqual(response.status_code, 405)
+
+    def test_record_api_denied(self):
+        make_api(self.api, 'Test', MyTestModel, MyTestSchema,
+                 record_authorizer=IsOwner())
+
+        with self.app.test_client() as c:
+            # IsOwner denies everything to anonymous users: no query is made.
+            response = c.get('/my-tests')
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data), {'data': []})
+
+            response = c.get('/my-tests/{}'.format(self.d1))
+            self.assertEqual(response.status_code, 403)
+
+            response = c.get('/my-tests/1000')
+            self.assertEqual(response.status_code, 404)
+
+    def test_permission_api(self):
+        add_session_management_urls(self.app)
+
+        make_api(self.api, 'Test', MyTestModel, MyTestSchema,
+                 record_authorizer=IsOwner(),
+                 api_authorizers=[my_test_acl.authorize])
+        # The owner of a book may not even read it through this API.
+        make_api(self.api, 'Book', MyTestModel, BookSchema,
+                 record_authorizer=IsOwner(),
+                 api_authorizers=[Acl().authorize])
+        make_permission_api(self.api)
+
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'Bob', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            secret = response['session_secret']
+
+            checks = [{'type': 'my-tests', 'id': str(i), 'op': op}
+                      for i in (self.d1, self.d2, 1000) for op in ('read', 'update')]
+            checks.append({'type': 'books', 'id': str(self.d2), 'op': 'read'})
+            post_data = json.dumps({'permissions': checks})
+            headers = HMACAuthenticator.get_authorization_headers(session_id,
+                                                                  secret,
+                                                                  '/permissions',
+                                                                  method='POST',
+                                                                  content_type='application/json',
+                                                                  body=post_data)
+            headers['Content-Type'] = 'application/json'
+            response = c.post('/permissions', data=post_data, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            # Bob owns d2, and the API ACL only lets managers read.
+            self.assertEqual(json.loads(response.data),
+                             {'permissions': {'my-tests': {
+                                 str(self.d1): {'read': False, 'update': False},
+                                 str(self.d2): {'read': True, 'update': False},
+                                 '1000': {'read': False, 'update': False}},
+                                             'books': {str(self.d2): {'read': False}}}})
+
+            # Unknown types, invalid ids and too many checks are rejected.
+            for checks in ([{'type': 'x', 'id': '1', 'op': 'read'}],
+                           [{'type': 'my-tests', 'id': 'abc', 'op': 'read'}],
+                           [{'type': 'my-tests', 'id': '1.5', 'op': 'read'}],
+                           [{'type': 'my-tests', 'id': ['1'], 'op': 'read'}],
+                           [{'type': 'my-tests', 'id': '1' * 30, 'op': 'read'}],
+                           [{'type': 'my-tests', 'id': '1', 'op': 'read'}] * 1001):
+                response = c.post('/permissions',
+                                  data=json.dumps({'permissions': checks}),
+                                  headers={'Content-Type': 'application/json'})
+                self.assertEqual(response.status_code, 400)
+            response = c.post('/permissions', data=json.dumps([]),
+                              headers={'Content-Type': 'application/json'})
+            self.assertEqual(response.status_code, 400)
+
+    def test_record_api_pagination(self):
+        make_api(self.api, 'Test', MyTestModel, MyTestSchema)
+
+        def ids(data):
+            return [d['id'] for d in data['data']]
+
+        with self.app.test_client() as c:
+            response = c.get('/my-tests?page[size]=2')
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertEqual(ids(data), ['1', '2'])
+
+            response = c.get(data['links']['next'])
+            data = json.loads(response.data)
+            self.assertEqual(ids(data), ['3'])
+            self.assertNotIn('links', data)
+
+            response = c.get('/my-tests?sort=-id&page[size]=2&author=Lewis Caroll')
+            data = json.loads(response.data)
+            self.assertEqual(ids(data), ['1'])
+
+            response = c.get('/my-tests?sort=-id&page[size]=2')
+            data = json.loads(response.data)
+            self.assertEqual(ids(data), ['3', '2'])
+            response = c.get(data['links']['next'])
+            self.assertEqual(ids(json.loads(response.data)), ['1'])
+
+            # The server limits the page size.
+            self.app.config['WOODBOX_MAX_PAGE_SIZE'] = 1
+            response = c.get('/my-tests?page[size]=10')
+            data = json.loads(response.data)
+            self.assertEqual(ids(data), ['1'])
+            self.assertIn('links', data)
+
+            # Title is not indexed.
+            response = c.get('/my-tests?sort=title')
+            self.assertEqual(response.status_code, 400)
+            response = c.get('/my-tests?page[after]=garbage')
+            self.assertEqual(response.status_code, 400)
+            # Tampered cursors: valid JSON, but not of the type of the sort key.
+            for sort, cursor in (('', '"1"'), ('', '[1, 2]'), ('', 'true'), ('', '{}'),
+                                 ('-id', '1'), ('-id', '["a", 1]'), ('-id', '[1, "a"]'),
+                                 ('-id', '[1, 2, 3]'), ('-id', '[null, 1]'),
+                                 ('', '1' * 30), ('-id', '[{}, 1]'.format('1' * 30)),
+                                 ('-id', '[1, {}]'.format(-2**63 - 1))):
+                url = '/my-tests?sort={}&page[after]={}'.format(sort, base64.urlsafe_b64encode(cursor))
+                response = c.get(url)
+                self.assertEqual(response.status_code, 400, cursor)
+            response = c.get('/my-tests?page[size]=0')
+            self.assertEqual(response.status_code, 400)
+
+    def test_record_api_streaming(self):
+        make_api(self.api, 'Test', MyTestModel, MyTestSchema)
+        api = Api(self.app, prefix='/streamed')
+        list_api = make_api(api, 'StreamedTest', MyTestModel, MyTestSchema, streaming=True)[1]
+        list_api.stream_chunk_size = 10
+
+        # The test client must not preserve the request context: it
+        # would not be popped after a streamed response.
+        c = self.app.test_client()
+        for query in ('', '?page[size]=2', '?sort=-id&page[size]=1', '?page[size]=1&page[after]=Mg==',
+                      '?author=Nobody'):
+            expected = json.loads(c.get('/my-tests' + query).data)
+            response = c.get('/streamed/my-tests' + query)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.mimetype, 'application/json')
+            data = json.loads(response.data)
+            if 'links' in expected:
+                self.assertEqual(data['links']['next'], '/streamed' + expected['links']['next'])
+                del data['links']
+                del expected['links']
+            self.assertEqual(data, expected)
+
+    def test_record_api_sparse_fields(self):
+        make_api(self.api, 'Test', MyTestModel, MyTestSchema)
+        statements = []
+
+        def record_statement(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+
+        with self.app.test_client() as c:
+            with self.app.app_context():
+                engine = db.engine
+            event.listen(engine, 'before_cursor_execute', record_statement)
+            try:
+                response = c.get('/my-tests?fields[my-tests]=title')
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(json.loads(response.data)['data'][0],
+                                 {'type': 'my-tests', 'id': '1',
+                                  'attributes': {'title': 'Alice in Wonderland'}})
+                self.assertNotIn('author', statements[-1])
+
+                del statements[:]
+                response = c.get('/my-tests/{}?fields[my-tests]=owner,owner-id'.format(self.d2))
+                self.assertEqual(response.status_code, 200)
+                attributes = json.loads(response.data)['data']['attributes']
+                self.assertEqual(sorted(attributes.keys()), ['owner', 'owner-id'])
+                self.assertEqual(attributes['owner']['data']['attributes']['username'], 'Bob')
+                self.assertFalse(any('title' in s for s in statements))
+            finally:
+                event.remove(engine, 'before_cursor_execute', record_statement)
+
+            response = c.get('/my-tests?fields[my-tests]=title,nothing')
+            self.assertEqual(response.status_code, 400)
+            response = c.get('/my-tests/{}?fields[my-tests]=nothing'.format(self.d1))
+            self.assertEqual(response.status_code, 400)
+
+    def test_record_api_include(self):
+        add_session_management_urls(self.app)
+
+        make_api(self.api, 'Book', MyTestModel, BookSchema)
+        make_api(self.api, 'Person', WBUserModel, PersonSchema,
+                 record_authorizer=IsOwner(owner_id_column='id'))
+        make_api(self.api, 'Role', WBRoleModel, RoleSchema)
+        streamed = Api(self.app, prefix='/streamed')
+        make_api(streamed, 'StreamedBook', MyTestModel, BookSchema, streaming=True)
+        make_api(streamed, 'StreamedPerson', WBUserModel, PersonSchema,
+                 record_authorizer=IsOwner(owner_id_column='id'))
+        make_api(streamed, 'StreamedRole', WBRoleModel, RoleSchema)
+
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'Bob', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            secret = response['session_secret']
+
+            # Bob may only read his own person record.
+            query = 'include=owner.roles&fields[people]=roles'
+            headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/books',
+                                                                  query_string=query)
+            response = c.get('/books?' + query, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            data = json.loads(response.data)
+            self.assertEqual([d['relationships']['owner']['data']['id'] for d in data['data']],
+                             [self.u1, self.u2, self.u3])
+            self.assertEqual(data['included'], [
+                {'type': 'people', 'id': str(self.u2),
+                 'relationships': {'roles': {'links': {}, 'data': [{'type': 'roles', 'id': 3}]}}},
+                {'type': 'roles', 'id': '3', 'attributes': {'rolename': 'manager'}}])
+
+            headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/streamed/books',
+                                                                  query_string=query)
+            response = c.get('/streamed/books?' + query, headers=headers)
+            self.assertEqual(json.loads(response.data), data)
+
+            url = '/books/{}'.format(self.d1)
+            headers = HMACAuthenticator.get_authorization_headers(session_id, secret, url,
+                                                                  query_string='include=owner')
+            response = c.get(url + '?include=owner', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['included'], [])
+
+            response = c.get('/books?include=title')
+            self.assertEqual(response.status_code, 400)
+            response = c.get('/books?include=owner.owner')
+            self.assertEqual(response.status_code, 400)
+            # The include parameter is checked before looking up the record.
+            response = c.get('/books/999999?include=title')
+            self.assertEqual(response.status_code, 400)
+
+    def test_record_api_include_api_acl(self):
+        add_session_management_urls(self.app)
+
+        acl = Acl()
+        acl.grants({
+            'manager': {
+                'Book': ['read'],
+                'Person': ['read'],
+            },
+            'admin': {
+                'Role': ['read'],
+            }
+        })
+        make_api(self.api, 'Book', MyTestModel, BookSchema, api_authorizers=[acl.authorize])
+        make_api(self.api, 'Person', WBUserModel, PersonSchema, api_authorizers=[acl.authorize])
+        make_api(self.api, 'Role', WBRoleModel, RoleSchema, api_authorizers=[acl.authorize])
+
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'Bob', 'password': 'a'})
+            response = json.loads(response.data)
+            session_id = response['session_id']
+            secret = response['session_secret']
+
+            # Bob may read the people, but not the roles API.
+            url = '/books/{}'.format(self.d2)
+            query = 'include=owner.roles&fields[people]=username'
+            headers = HMACAuthenticator.get_authorization_headers(session_id, secret, url,
+                                                                  query_string=query)
+            response = c.get(url + '?' + query, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(json.loads(response.data)['included'], [
+                {'type': 'people', 'id': str(self.u2), 'attributes': {'username': 'Bob'}}])
+
+            headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/books',
+                                                                  query_string='include=owner.roles')
+            response = c.get('/books?include=owner.roles', headers=headers)
+            self.assertEqual(response.status_code, 200)
+            included = json.loads(response.data)['included']
+            self.assertEqual(sorted(d['id'] for d in included),
+                             sorted([str(self.u1), str(self.u2), str(self.u3)]))
+            self.assertEqual(set(d['type'] for d in included), {'people'})
@@ -9,10 +9,13 @@ from time import sleep
 import arrow
 
 from flask import request
+from sqlalchemy import event
+from sqlalchemy.orm import Session
 
 from woodbox.db import db
 from woodbox.models.session_model import WBSessionModel
 from woodbox.models.user_model import WBUserModel
+from woodbox.password_hasher import password_hasher
 from woodbox.session import authenticate, validate_session, invalidate_session, add_session_management_urls
 from woodbox.tests.flask_test_case import FlaskTestCase
 
@@ -54,6 +57,48 @@ class SessionTestCase(FlaskTestCase):
             self.assertIsNone(session)
             self.assertEqual(response['err'], 1)
 
+    def test_authenticate_rehash(self):
+        with self.app.test_request_context('/'):
+            user = WBUserModel.query.get(self.u1)
+            user.hashed_password = WBUserModel.hash_password_legacy('a')
+            db.session.commit()
+
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+            response = json.loads(response.data)
+            self.assertEqual(response['err'], 0)
+            user = WBUserModel.query.get(self.u1)
+            self.assertTrue(user.hashed_password.startswith('pbkdf2_sha256$'))
+            self.assertFalse(user.needs_rehash())
+
+    def test_authenticate_narrow_column(self):
+        with self.app.test_request_context('/'):
+            user = WBUserModel.query.get(self.u1)
+            legacy = user.hashed_password = WBUserModel.hash_password_legacy('a')
+            db.session.commit()
+
+        # The column of an older database, that is not widened yet.
+        WBUserModel._password_column_length = 64
+        try:
+            with self.app.test_client() as c:
+                response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+                response = json.loads(response.data)
+                self.assertEqual(response['err'], 0)
+                self.assertEqual(WBUserModel.query.get(self.u1).hashed_password, legacy)
+        finally:
+            WBUserModel._password_column_length = False
+
+    def test_authenticate_busy(self):
+        password_hasher.configure(1, max_pending=0)
+        try:
+            with self.app.test_client() as c:
+                response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+                self.assertEqual(response.status_code, 503)
+                response = json.loads(response.data)
+                self.assertEqual(response['err'], 5)
+        finally:
+            password_hasher.configure(0)
+
     def test_authenticate_bad_param(self):
         with self.app.test_client() as c:
             response = c.post('/authenticate', data={'username': 'a'})
@@ -108,6 +153,29 @@ class SessionTestCase(FlaskTestCase):
             response = json.loads(response.data)
             self.assertEqual(response['err'], 3)
 
+    def test_invalidate_cached_during_commit(self):
+        with self.app.test_client() as c:
+            response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+            session_id = json.loads(response.data)['session_id']
+            with self.app.test_request_context('/'):
+                credentials = WBSessionModel.get_credentials(session_id)
+
+            # A concurrent request caches the credentials while the
+            # session is being deleted.
+            def cache_credentials(session):
+                WBSessionModel.credential_cache.set(session_id, credentials)
+
+            event.listen(Session, 'before_commit', cache_credentials)
+            try:
+                response = c.post('/invalidate-session', data={'session_id': session_id})
+            finally:
+                event.remove(Session, 'before_commit', cache_credentials)
+            self.assertEqual(json.loads(response.data)['err'], 0)
+            self.assertIsNone(WBSessionModel.credential_cache.get(session_id))
+
+            with self.app.test_request_context('/'):
+                self.assertIsNone(WBSessionModel.get_credentials(session_id))
+
     def test_invalidate_bad_session(self):
         with self.app.test_client() as c:
             response = c.post('/invalidate-session', data={'session_id': 'garbage'})
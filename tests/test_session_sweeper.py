@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+from datetime import timedelta
+from Queue import Queue
+
+import arrow
+
+from twisted.internet.task import Clock
+
+from woodbox.db import db
+from woodbox.models.session_model import SessionAccessRecorder, WBSessionModel
+from woodbox.models.user_model import WBUserModel
+from woodbox.session_sweeper import AccessTimeFlusher, SessionSweeper
+from woodbox.tests.flask_test_case import FlaskTestCase
+
+
+class FakeThreadPool(object):
+    def __init__(self):
+        self.q = Queue()
+
+
+class SessionSweeperTestCase(FlaskTestCase):
+    def setUp(self):
+        super(SessionSweeperTestCase, self).setUp()
+
+        with self.app.test_request_context('/'):
+            db.initialize()
+            user = WBUserModel(username='a', password='a', roles=[])
+            db.session.add(user)
+            db.session.commit()
+
+            sessions = [WBSessionModel(user.id) for i in range(5)]
+            old = arrow.utcnow() - timedelta(seconds=WBSessionModel.session_max_idle_time + 1)
+            for s in sessions[:4]:
+                s.accessed = old
+            db.session.add_all(sessions)
+            db.session.commit()
+
+        self.clock = Clock()
+        self.threadpool = FakeThreadPool()
+
+    def test_sweep(self):
+        sweeper = SessionSweeper(self.app, batch_size=3, reactor=self.clock, threadpool=self.threadpool)
+        self.assertEqual(sweeper.sweep(), 4)
+        self.assertEqual(sweeper.last_removed, 4)
+        self.assertEqual(sweeper.total_removed, 4)
+        with self.app.test_request_context('/'):
+            self.assertEqual(WBSessionModel.query.count(), 1)
+
+    def test_back_off(self):
+        sweeper = SessionSweeper(self.app, interval=10, max_interval=30,
+                                 reactor=self.clock, threadpool=self.threadpool)
+        self.threadpool.q.put(None)
+        sweeper.start()
+        self.clock.advance(10)
+        self.assertEqual(sweeper.current_interval, 20)
+        self.clock.advance(20)
+        self.assertEqual(sweeper.current_interval, 30)
+        self.clock.advance(30)
+        self.assertEqual(sweeper.current_interval, 30)
+        sweeper.stop()
+        self.assertEqual(sweeper.total_removed, 0)
+
+    def test_access_time_flusher(self):
+        with self.app.test_request_context('/'):
+            session = WBSessionModel.query.order_by(WBSessionModel.id).first()
+            session_id = session.id
+            old = session.accessed
+        recorder = SessionAccessRecorder(flush_interval=5)
+        recorder.record(session_id, arrow.utcnow())
+
+        flusher = AccessTimeFlusher(self.app, recorder, reactor=self.clock, threadpool=self.threadpool)
+        self.assertEqual(flusher.interval, 5)
+        flusher.start()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        flusher.stop()
+        self.assertEqual(len(self.clock.getDelayedCalls()), 0)
+
+        self.assertEqual(flusher.flush(), 1)
+        self.assertEqual(recorder.pending, {})
+        with self.app.test_request_context('/'):
+            self.assertGreater(WBSessionModel.query.get(session_id).accessed, old)
@@ -0,0 +1,143 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+import time
+import unittest
+
+from flask import g
+
+from woodbox.authenticator import HMACAuthenticator
+from woodbox.db import db
+from woodbox.models.session_model import WBSessionModel
+from woodbox.models.user_model import WBUserModel
+from woodbox.session import add_session_management_urls
+from woodbox.stateless_session import RevocationList, StatelessSession
+from woodbox.tests.flask_test_case import FlaskTestCase
+
+
+@HMACAuthenticator.authenticate
+def needs_authenticated_user_function():
+    if g.user:
+        return str(g.user)
+    else:
+        return 'anonymous'
+
+
+class StatelessSessionTestCase(FlaskTestCase):
+    def setUp(self):
+        super(StatelessSessionTestCase, self).setUp()
+        self.app.config['WOODBOX_SESSION_MASTER_KEY'] = 'master key'
+
+        add_session_management_urls(self.app)
+        self.app.add_url_rule('/test', 'test', needs_authenticated_user_function, methods=['GET'])
+
+        with self.app.test_request_context('/'):
+            db.initialize()
+
+            # Create a user
+            self.u1 = WBUserModel(username='a', password='a', roles=[])
+            db.session.add(self.u1)
+            db.session.commit()
+
+            self.u1 = self.u1.id
+
+    def authenticate(self, c):
+        response = c.post('/authenticate', data={'username': 'a', 'password': 'a'})
+        response = json.loads(response.data)
+        self.assertEqual(response['err'], 0)
+        return response['session_id'], response['session_secret']
+
+    def test_authenticate(self):
+        with self.app.test_client() as c:
+            session_id, secret = self.authenticate(c)
+            self.assertTrue(session_id.startswith(StatelessSession.prefix))
+            self.assertEqual(WBSessionModel.query.count(), 0)
+
+            auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/test')
+            response = c.get('/test', headers=auth_headers)
+            self.assertEqual(g.user_reason, 'Authenticated')
+            self.assertEqual(response.data, str(self.u1))
+
+    def test_validate_invalidate(self):
+        with self.app.test_client() as c:
+            session_id, secret = self.authenticate(c)
+
+            response = json.loads(c.post('/validate-session', data={'session_id': session_id}).data)
+            self.assertEqual(response['err'], 0)
+            self.assertEqual(response['session_secret'], secret)
+
+            response = json.loads(c.post('/invalidate-session', data={'session_id': session_id}).data)
+            self.assertEqual(response['err'], 0)
+
+            response = json.loads(c.post('/validate-session', data={'session_id': session_id}).data)
+            self.assertEqual(response['err'], 3)
+
+            auth_headers = HMACAuthenticator.get_authorization_headers(session_id, secret, '/test')
+            response = c.get('/test', headers=auth_headers)
+            self.assertEqual(g.user_reason, 'Invalid credential.')
+            self.assertEqual(response.data, 'anonymous')
+
+    def test_tampered_credential(self):
+        with self.app.test_client() as c:
+            session_id, secret = self.authenticate(c)
+            prefix, user_id, expiry, nonce, tag = session_id.split('.')
+            forged = '.'.join([prefix, user_id, str(int(expiry) + 3600), nonce, tag])
+
+            auth_headers = HMACAuthenticator.get_authorization_headers(forged, secret, '/test')
+            response = c.get('/test', headers=auth_headers)
+            self.assertEqual(g.user_reason, 'Invalid credential.')
+            self.assertEqual(response.data, 'anonymous')
+
+    def test_forged_credential(self):
+        with self.app.test_client() as c:
+            expiry = int(time.time()) + 600
+            for forged in ('wbs1.{}.{}.deadbeef'.format(self.u1, expiry),
+                           'wbs1.{}.{}.deadbeef.{}'.format(self.u1, expiry, '0' * 64),
+                           'wbs1.{}.{}.deadbeef.\xe9'.format(self.u1, expiry)):
+                response = json.loads(c.post('/validate-session', data={'session_id': forged}).data)
+                self.assertEqual(response['err'], 3)
+                self.assertNotIn('session_secret', response)
+
+                # The secret a server would derive for the forged credential is not accepted.
+                with self.app.test_request_context('/'):
+                    secret = StatelessSession.derive_secret(forged)
+                auth_headers = HMACAuthenticator.get_authorization_headers(forged, secret, '/test')
+                response = c.get('/test', headers=auth_headers)
+                self.assertEqual(g.user_reason, 'Invalid credential.')
+                self.assertEqual(response.data, 'anonymous')
+
+    def test_get_credentials(self):
+        with self.app.test_request_context('/'):
+            self.assertIsNone(StatelessSession.get_credentials('wbs1.1.2.3.4'))
+            self.assertIsNone(StatelessSession.get_credentials('wbs1.a.2.3'))
+            # Expired
+            payload = 'wbs1.1.2.abcd'
+            self.assertIsNone(StatelessSession.get_credentials(
+                '{}.{}'.format(payload, StatelessSession.sign(payload))))
+            # Signed, but expires later than a credential issued now.
+            payload = 'wbs1.1.{}.abcd'.format(int(time.time()) + 2 * StatelessSession.lifetime)
+            self.assertIsNone(StatelessSession.get_credentials(
+                '{}.{}'.format(payload, StatelessSession.sign(payload))))
+
+            session_id, secret = StatelessSession.issue(self.u1)
+            credentials = StatelessSession.get_credentials(session_id)
+            self.assertEqual(credentials.user_id, self.u1)
+            self.assertEqual(credentials.secret, secret)
+
+            self.app.config['WOODBOX_SESSION_MASTER_KEY'] = None
+            self.assertIsNone(StatelessSession.get_credentials(session_id))
+
+
+class RevocationListTestCase(unittest.TestCase):
+    def test_expiration(self):
+        self.now = 0
+        revoked = RevocationList(timer=lambda: self.now)
+        revoked.add('a', 10)
+        revoked.add('b', 20)
+        self.assertIn('a', revoked)
+        self.now = 15
+        revoked.add('c', 30)
+        self.assertNotIn('a', revoked)
+        self.assertIn('b', revoked)
+        self.assertEqual(len(revoked), 2)
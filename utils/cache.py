@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+import threading
+import time
+
+from collections import OrderedDict
+
+
+class TTLCache(object):
+    """A bounded, thread safe LRU cache whose entries expire after `ttl` seconds.
+
+    When the cache is full, the least recently used entry is
+    evicted. Expired entries are dropped when they are looked up.
+
+    Hit, miss and eviction counters are available through :meth:`stats`.
+
+    Arguments:
+    maxsize -- maximum number of entries
+    ttl -- time to live of an entry, in seconds
+
+    Keyword arguments:
+    timer -- function returning the current time in seconds, default to ``time.time``
+
+    """
+    _missing = object()
+
+    def __init__(self, maxsize, ttl, timer=time.time):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.timer = timer
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return self.get(key, self._missing) is not self._missing
+
+    def get(self, key, default=None):
+        """Return the value for `key`, or `default` if it is missing or expired."""
+        with self._lock:
+            entry = self._data.pop(key, self._missing)
+            if entry is not self._missing:
+                expires, value = entry
+                if expires > self.timer():
+                    # Re-insert the entry to mark it as most recently used.
+                    self._data[key] = entry
+                    self.hits += 1
+                    return value
+                self.evictions += 1
+            self.misses += 1
+            return default
+
+    def set(self, key, value):
+        """Store `value` under `key`, evicting the least recently used entry if needed."""
+        with self._lock:
+            self._data.pop(key, None)
+            while len(self._data) >= self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+            self._data[key] = (self.timer() + self.ttl, value)
+
+    def evict(self, key):
+        """Remove `key` from the cache. Return True if it was present."""
+        with self._lock:
+            if self._data.pop(key, self._missing) is self._missing:
+                return False
+            self.evictions += 1
+            return True
+
+    def clear(self):
+        with self._lock:
+            self.evictions += len(self._data)
+            self._data.clear()
+
+    def stats(self):
+        """Return a dict with the cache counters."""
+        return {'size': len(self._data),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
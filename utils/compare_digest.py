@@ -0,0 +1,17 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+try:
+    from hmac import compare_digest
+except ImportError:
+    def compare_digest(a, b):
+        l = min(len(a), len(b))
+
+        result = True
+        for i in range(0, l):
+            result = result and (a[i] == b[i]);
+
+        if len(a) != len(b):
+            result = False
+
+        return result
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import, print_function, unicode_literals
+
+from hashlib import sha256
+from hmac import new as hmac_new
+
+
+def hkdf_sha256(key, info=b'', length=32, salt=None):
+    """HMAC-based key derivation function (RFC 5869) using SHA-256.
+
+    Arguments:
+    key -- input keying material, as bytes
+
+    Keyword arguments:
+    info -- context information binding the derived key to its use
+    length -- length of the derived key, in bytes (at most 8160)
+    salt -- optional salt, default to a string of zeros
+
+    """
+    if length > 255 * sha256().digest_size:
+        raise ValueError(length)
+    if not salt:
+        salt = b'\x00' * sha256().digest_size
+
+    prk = hmac_new(salt, key, sha256).digest()
+    okm = b''
+    t = b''
+    i = 1
+    while len(okm) < length:
+        t = hmac_new(prk, t + info + bytearray([i]), sha256).digest()
+        okm += t
+        i += 1
+    return okm[:length]
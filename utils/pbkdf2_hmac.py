@@ -1,68 +1,104 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import, print_function, unicode_literals
 
+import binascii
+import struct
+from hashlib import new
+
+_trans_5C = bytes(bytearray(x ^ 0x5C for x in range(256)))
+_trans_36 = bytes(bytearray(x ^ 0x36 for x in range(256)))
+
+# Number of digests converted to an integer at once.
+_batch_size = 1024
+
+
+def _xor_blocks(data, size):
+    """Return the XOR of the `size` bytes blocks of `data`, as an integer.
+
+    `data` is converted to an integer once, then folded in halves, so
+    that the number of Python operations is logarithmic in the number
+    of blocks.
+    """
+    n = len(data) // size
+    bits = 8 * size
+    x = int(binascii.hexlify(data), 16)
+    while n > 1:
+        if n % 2:
+            low = x & ((1 << bits) - 1)
+            x >>= bits
+            n -= 1
+        else:
+            low = 0
+        n //= 2
+        x = (x >> (n * bits)) ^ (x & ((1 << (n * bits)) - 1)) ^ low
+    return x
+
+
+def _pbkdf2_hmac_py(hash_name, password, salt, iterations, dklen=None):
+    """Password based key derivation function 2 (PKCS #5 v2.0)
+
+    This Python implementations based on the hmac module about as fast
+    as OpenSSL's PKCS5_PBKDF2_HMAC for short passwords and much faster
+    for long passwords.
+    """
+    if not isinstance(hash_name, str):
+        raise TypeError(hash_name)
+
+    if not isinstance(password, (bytes, bytearray)):
+        password = bytes(buffer(password))
+    if not isinstance(salt, (bytes, bytearray)):
+        salt = bytes(buffer(salt))
+
+    # Fast inline HMAC implementation
+    inner = new(hash_name)
+    outer = new(hash_name)
+    blocksize = getattr(inner, 'block_size', 64)
+    if len(password) > blocksize:
+        password = new(hash_name, password).digest()
+    password = password + b'\x00' * (blocksize - len(password))
+    inner.update(password.translate(_trans_36))
+    outer.update(password.translate(_trans_5C))
+
+    if iterations < 1:
+        raise ValueError(iterations)
+    if dklen is None:
+        dklen = outer.digest_size
+    if dklen < 1:
+        raise ValueError(dklen)
+
+    digest_size = outer.digest_size
+    hex_format_string = "%%0%ix" % (digest_size * 2)
+    inner_copy = inner.copy
+    outer_copy = outer.copy
+
+    dkey = b''
+    loop = 1
+    while len(dkey) < dklen:
+        # PBKDF2_HMAC uses the password as key. We can re-use the same
+        # digest objects and just update copies to skip initialization.
+        # The digests are XORed a batch at a time.
+        prev = salt + struct.pack(b'>I', loop)
+        rkey = 0
+        batch = []
+        for i in xrange(iterations):
+            icpy = inner_copy()
+            icpy.update(prev)
+            ocpy = outer_copy()
+            ocpy.update(icpy.digest())
+            prev = ocpy.digest()
+            batch.append(prev)
+            if len(batch) == _batch_size:
+                rkey ^= _xor_blocks(b''.join(batch), digest_size)
+                batch = []
+        if batch:
+            rkey ^= _xor_blocks(b''.join(batch), digest_size)
+        loop += 1
+        dkey += binascii.unhexlify(hex_format_string % rkey)
+
+    return dkey[:dklen]
+
+
 try:
     from hashlib import pbkdf2_hmac
 except ImportError:
-    import binascii
-    import struct
-    from hashlib import new
-
-    _trans_5C = b"".join(chr(x ^ 0x5C) for x in range(256))
-    _trans_36 = b"".join(chr(x ^ 0x36) for x in range(256))
-
-    def pbkdf2_hmac(hash_name, password, salt, iterations, dklen=None):
-        """Password based key derivation function 2 (PKCS #5 v2.0)
-
-        This Python implementations based on the hmac module about as fast
-        as OpenSSL's PKCS5_PBKDF2_HMAC for short passwords and much faster
-        for long passwords.
-        """
-        if not isinstance(hash_name, str):
-            raise TypeError(hash_name)
-
-        if not isinstance(password, (bytes, bytearray)):
-            password = bytes(buffer(password))
-        if not isinstance(salt, (bytes, bytearray)):
-            salt = bytes(buffer(salt))
-
-        # Fast inline HMAC implementation
-        inner = new(hash_name)
-        outer = new(hash_name)
-        blocksize = getattr(inner, 'block_size', 64)
-        if len(password) > blocksize:
-            password = new(hash_name, password).digest()
-        password = password + b'\x00' * (blocksize - len(password))
-        inner.update(password.translate(_trans_36))
-        outer.update(password.translate(_trans_5C))
-
-        def prf(msg, inner=inner, outer=outer):
-            # PBKDF2_HMAC uses the password as key. We can re-use the same
-            # digest objects and just update copies to skip initialization.
-            icpy = inner.copy()
-            ocpy = outer.copy()
-            icpy.update(msg)
-            ocpy.update(icpy.digest())
-            return ocpy.digest()
-
-        if iterations < 1:
-            raise ValueError(iterations)
-        if dklen is None:
-            dklen = outer.digest_size
-        if dklen < 1:
-            raise ValueError(dklen)
-
-        hex_format_string = "%%0%ix" % (new(hash_name).digest_size * 2)
-
-        dkey = b''
-        loop = 1
-        while len(dkey) < dklen:
-            prev = prf(salt + struct.pack(b'>I', loop))
-            rkey = int(binascii.hexlify(prev), 16)
-            for i in xrange(iterations - 1):
-                prev = prf(prev)
-                rkey ^= int(binascii.hexlify(prev), 16)
-            loop += 1
-            dkey += binascii.unhexlify(hex_format_string % rkey)
-
-        return dkey[:dklen]
+    pbkdf2_hmac = _pbkdf2_hmac_py
@@ -3,9 +3,11 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import unittest
 
-from binascii import hexlify
+from binascii import hexlify, unhexlify
 
-from woodbox.utils.pbkdf2_hmac import pbkdf2_hmac
+from woodbox.utils.cache import TTLCache
+from woodbox.utils.hkdf import hkdf_sha256
+from woodbox.utils.pbkdf2_hmac import pbkdf2_hmac, _pbkdf2_hmac_py
 
 class TestUtils(unittest.TestCase):
     def test_pbkdf2_hmac(self):
@@ -19,3 +21,64 @@ class TestUtils(unittest.TestCase):
         for t in tests:
             r = hexlify(pbkdf2_hmac(str('sha256'), t[0], t[1], 100))
             self.assertEqual(r, t[2])
+            r = hexlify(_pbkdf2_hmac_py(str('sha256'), t[0], t[1], 100))
+            self.assertEqual(r, t[2])
+
+    def test_pbkdf2_hmac_py_rfc6070(self):
+        tests = [
+            (b'password', b'salt', 1, 20, b'0c60c80f961f0e71f3a9b524af6012062fe037a6'),
+            (b'password', b'salt', 2, 20, b'ea6c014dc72d6f8ccd1ed92ace1d41f0d8de8957'),
+            (b'password', b'salt', 4096, 20, b'4b007901b765489abead49d926f721d065a429c1'),
+            (b'passwordPASSWORDpassword', b'saltSALTsaltSALTsaltSALTsaltSALTsalt', 4096, 25,
+             b'3d2eec4fe41c849b80c8d83662c0e44a8b291a964cf2f07038'),
+            (b'pass\0word', b'sa\0lt', 4096, 16, b'56fa6aa75548099dcc37d7f03425e0c3'),
+        ]
+
+        for t in tests:
+            r = hexlify(_pbkdf2_hmac_py(str('sha1'), t[0], t[1], t[2], t[3]))
+            self.assertEqual(r, t[4])
+
+    def test_hkdf_sha256(self):
+        # RFC 5869, test cases 1 and 3.
+        okm = hkdf_sha256(b'\x0b' * 22, info=unhexlify(b'f0f1f2f3f4f5f6f7f8f9'), length=42,
+                          salt=unhexlify(b'000102030405060708090a0b0c'))
+        self.assertEqual(hexlify(okm), b'3cb25f25faacd57a90434f64d0362f2a2d2d0a90cf1a5a4c5db02d56ecc4c5bf34007208d5b887185865')
+        okm = hkdf_sha256(b'\x0b' * 22, length=42)
+        self.assertEqual(hexlify(okm), b'8da4e775a563c18f715f802a063c5a31b8a11f5c5ee1879ec3454e5f3c738d2d9d201395faa4b61a96c8')
+
+
+class TestTTLCache(unittest.TestCase):
+    def setUp(self):
+        self.now = 0
+        self.cache = TTLCache(maxsize=2, ttl=10, timer=lambda: self.now)
+
+    def test_get_set(self):
+        self.assertIsNone(self.cache.get('a'))
+        self.cache.set('a', 1)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertEqual(self.cache.stats()['hits'], 1)
+        self.assertEqual(self.cache.stats()['misses'], 1)
+
+    def test_lru_eviction(self):
+        self.cache.set('a', 1)
+        self.cache.set('b', 2)
+        self.cache.get('a')
+        self.cache.set('c', 3)
+        self.assertEqual(self.cache.get('a'), 1)
+        self.assertIsNone(self.cache.get('b'))
+        self.assertEqual(self.cache.get('c'), 3)
+        self.assertEqual(self.cache.stats()['evictions'], 1)
+
+    def test_expiration(self):
+        self.cache.set('a', 1)
+        self.now = 9
+        self.assertEqual(self.cache.get('a'), 1)
+        self.now = 10
+        self.assertIsNone(self.cache.get('a'))
+        self.assertEqual(len(self.cache), 0)
+
+    def test_evict(self):
+        self.cache.set('a', 1)
+        self.assertTrue(self.cache.evict('a'))
+        self.assertFalse(self.cache.evict('a'))
+        self.assertNotIn('a', self.cache)